@@ -8,7 +8,9 @@ export NAME=$1
 export LOCAL_ADDR=$2
 export LOCAL_VPN_DIR=$3
 
+# if dynvpn has a master connection open to the container (ssh_mux), run over it
 SSH="ssh -i ~/.ssh/id.openvpn \
+        ${DYNVPN_SSH_CONTROL:+-o ControlPath=$DYNVPN_SSH_CONTROL -o ControlMaster=no} \
         -o ConnectTimeout=5 \
         -o StrictHostKeyChecking=off \
         openvpn@$LOCAL_ADDR"
@@ -8,7 +8,9 @@ set -o nounset
 
 : {$TIMEOUT:=3}
 
+# if dynvpn has a master connection open to the container (ssh_mux), run over it
 ssh -i ~/.ssh/id.openvpn \
+    ${DYNVPN_SSH_CONTROL:+-o ControlPath=$DYNVPN_SSH_CONTROL -o ControlMaster=no} \
     -o StrictHostKeyChecking=off \
     -o ConnectTimeout=5 \
     openvpn@$LOCAL_ADDR \
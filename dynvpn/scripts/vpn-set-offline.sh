@@ -7,7 +7,8 @@ NAME=$1
 LOCAL_ADDR=$2
 LOCAL_VPN_DIR=$3
 
-ssh="ssh -i ~/.ssh/id.openvpn -o StrictHostKeyChecking=off openvpn@$LOCAL_ADDR"
+# if dynvpn has a master connection open to the container (ssh_mux), run over it
+ssh="ssh -i ~/.ssh/id.openvpn ${DYNVPN_SSH_CONTROL:+-o ControlPath=$DYNVPN_SSH_CONTROL -o ControlMaster=no} -o StrictHostKeyChecking=off openvpn@$LOCAL_ADDR"
 
 $ssh killall openvpn
 
@@ -11,7 +11,9 @@ export SITE_ID=$4
 export LOCAL_GATEWAY=$5
 
 
+# if dynvpn has a master connection open to the container (ssh_mux), run over it
 SSH="ssh    \
+            ${DYNVPN_SSH_CONTROL:+-o ControlPath=$DYNVPN_SSH_CONTROL -o ControlMaster=no} \
             -o SendEnv=NAME \
             -o SendEnv=LOCAL_VPN_DIR \
             -o StrictHostKeyChecking=off \
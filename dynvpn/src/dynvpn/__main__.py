@@ -2,27 +2,11 @@
 
 import argparse
 import logging
-import yaml
 import asyncio
 import sys
 
 from dynvpn.node import node
-
-local_defaults = {
-
-    'failed_status_timeout': 0,
-
-    'local_vpn_check_interval': 10,
-    'local_vpn_check_timeout': 3,
-    'local_vpn_check_retries': 1,
-
-    'online_check_delay': 2,
-
-    'pull_interval': 30,
-    'pull_timeout': 10,
-
-    'replica_mode': 'Manual'
-}
+from dynvpn.config import load_config
 
 async def main():
 
@@ -47,17 +31,10 @@ async def main():
     h.setFormatter(fmt)
     logger.addHandler(h)
 
-    with open(args["local_config"], 'rb') as f:
-        local_config=yaml.safe_load(f)
-
-    with open(args["global_config"], 'rb') as f:
-        global_config=yaml.safe_load(f)
-
-    for k, default in local_defaults.items():
-        if k not in local_config:
-            local_config[k]=default
+    config_files=(args["local_config"], args["global_config"])
+    (local_config, global_config)=load_config(*config_files)
 
-    instance = node(local_config['site_id'], local_config, global_config, logger)
+    instance = node(local_config['site_id'], local_config, global_config, logger, config_files)
     try:
         await instance.start()
     except KeyboardInterrupt:
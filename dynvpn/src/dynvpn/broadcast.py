@@ -0,0 +1,66 @@
+import asyncio
+import logging
+
+from typing import Optional, Dict
+
+from dynvpn.common import push_result_t
+
+"""
+coalesces requests to broadcast our state to peers
+
+a single operation on a local VPN (such as vpn_online) can change its status several times in
+quick succession, and many VPNs can change status at around the same time (for example at startup).
+since each push contains our entire current state, only the last push in a burst is useful.
+
+instead of broadcasting immediately, `request` starts a short timer (`broadcast_coalesce_delay`),
+and all requests made before it expires are served by a single call to node.broadcast_state.
+`flush` broadcasts immediately, for status changes which peers need to learn of without delay
+"""
+class broadcast_coalescer():
+
+    def __init__(self, node, logger : logging.Logger):
+        self.node=node
+        self._logger=logger
+
+        self._delay=float(node.local_config['broadcast_coalesce_delay'])
+
+        # the pending timer task, if any
+        self._timer : Optional[asyncio.Task]=None
+        # number of requests which will be served by the pending broadcast
+        self._requests=0
+        # used to give each timer task a unique name in the task_manager
+        self._seq=0
+
+    """
+    request a broadcast, which will be sent at most `broadcast_coalesce_delay` seconds from now
+    """
+    async def request(self) -> None:
+        if self._delay <= 0:
+            await self.flush()
+            return
+
+        self._requests += 1
+
+        if self._timer is None:
+            self._seq += 1
+            tname=f'broadcast-coalesce({self._seq})'
+            self.node.task_manager.add(self._run(), tname)
+            self._timer=self.node.task_manager.find(tname)
+
+    """
+    broadcast immediately, serving any pending request
+    """
+    async def flush(self) -> Dict[str, push_result_t]:
+        if self._timer is not None and self._timer is not asyncio.current_task():
+            self._timer.cancel()
+        self._timer=None
+
+        if self._requests > 1:
+            self._logger.debug(f'broadcast_coalescer: coalesced {self._requests} requests')
+        self._requests=0
+
+        return await self.node.broadcast_state()
+
+    async def _run(self):
+        await asyncio.sleep(self._delay)
+        await self.flush()
@@ -0,0 +1,89 @@
+import asyncio
+import logging
+import time
+
+from typing import Dict
+
+"""
+batches the connectivity checks of local VPNs into rounds
+
+without batching, each Online VPN is checked on its own schedule, so the checks of N VPNs are
+spread over N separate timers. with batching (`local_vpn_check_batch`), the scheduler runs the
+check-vpn entries of all VPNs together, at the same multiples of `local_vpn_check_interval`
+(see scheduler.schedule, `phase`), and each calls `check` instead of checking on its own. the
+first call starts a round, which checks all VPNs that are waiting at that point concurrently,
+through the probe backend (see probe.py).
+
+each VPN is still checked with node.check_local_vpn_connectivity, so local_vpn_check_retries
+applies per VPN, and a VPN's failure is handled by its own check-vpn entry as before
+"""
+class check_batcher():
+
+    def __init__(self, node, logger : logging.Logger):
+        self.node=node
+        self._logger=logger
+
+        # vname -> future resolved with the VPN's result in the next round
+        self._waiting : Dict[str, asyncio.Future]={}
+
+        # whether a round has been scheduled which hasn't started yet
+        self._pending=False
+        # used to give each round a unique name
+        self._seq=0
+
+        self.counters={
+            'rounds': 0,
+            'checks': 0,
+            'largest_round': 0,
+            'last_round_duration': 0.0,
+        }
+
+    """
+    wait for the next round, and return whether the VPN passed its connectivity check
+    """
+    async def check(self, vname : str) -> bool:
+        if (fut := self._waiting.get(vname)) is None or fut.done():
+            fut=self._waiting[vname]=asyncio.get_running_loop().create_future()
+
+        # the round runs once the scheduler has started all the check-vpn entries due with this one
+        if not self._pending:
+            self._pending=True
+            self._seq += 1
+            self.node.scheduler.schedule(f'check-vpn-batch({self._seq})', self._round, 0)
+
+        # if the check-vpn task is cancelled while waiting, so is the future, and the VPN is left out
+        #   of the round
+        return await fut
+
+    async def _round(self):
+        self._pending=False
+
+        batch={ vname: fut for vname, fut in self._waiting.items() if not fut.done() }
+        self._waiting={}
+
+        start=time.monotonic()
+        results=await asyncio.gather(
+            *[ self.node.check_local_vpn_connectivity(vname) for vname in batch ],
+            return_exceptions=True
+        )
+
+        for (fut, result) in zip(batch.values(), results):
+            if fut.done():
+                continue
+            if isinstance(result, BaseException):
+                fut.set_exception(result)
+            else:
+                fut.set_result(result)
+
+        self.counters['rounds'] += 1
+        self.counters['checks'] += len(batch)
+        self.counters['largest_round']=max(self.counters['largest_round'], len(batch))
+        self.counters['last_round_duration']=time.monotonic() - start
+
+        self._logger.debug(f'check_batcher: checked {len(batch)} VPNs in {self.counters["last_round_duration"]:.3f}s')
+
+    def stats(self):
+        return {
+            **self.counters,
+            'waiting': len(self._waiting),
+        }
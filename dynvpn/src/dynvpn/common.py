@@ -1,12 +1,12 @@
 
 from enum import Enum, auto
-from typing import Optional, Dict, Tuple, List
+from typing import Optional, Dict, Tuple, List, Callable
 
 import datetime
 import functools
 import asyncio
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from ipaddress import IPv4Address, IPv4Network, ip_address
 import logging
 import json
@@ -71,6 +71,20 @@ class site_status_t(status):
     Admin_offline = auto()
 
 
+# outcome of pushing our state to a single peer
+class push_result_t(enum_base):
+    Ok = auto()
+    Failed = auto()
+    # the peer was not contacted, for example because its site is Offline
+    Skipped = auto()
+
+
+# kinds of per-VPN tasks, see task_manager.find_vpn
+class task_kind_t(enum_base):
+    Check_vpn = auto()
+    Failure_retry = auto()
+
+
 class lock_status_t(enum_base):
     Locked = auto()
     Unlocked = auto()
@@ -85,9 +99,17 @@ TODO contextmanager with optional lock to match what we see in node.vpn_*
     currently can't use asyncio contextmanager without checking lock argument first
 """
 class dynvpn_lock():
+
+    # task -> locks currently held by that task
+    # lets the task_manager release the locks of a task which exits without unlocking them, 
+    #   without visiting every lock (see release_held)
+    _held_by : Dict[asyncio.Task, set]={}
+
     def __init__(self, trace=False, name=None) -> None:
         self._lock=asyncio.Lock()
         self.locked_task : Optional[str]=None
+        # the task object named by locked_task
+        self._owner : Optional[asyncio.Task]=None
         self._trace=trace
         self._name=name
         self._logger=logging.getLogger('dynvpn')
@@ -118,6 +140,8 @@ class dynvpn_lock():
             if self._trace:
                 self._logtrace('lock', f'task {tname} acquired')
             self.locked_task = tname
+            self._owner=asyncio.current_task()
+            dynvpn_lock._held_by.setdefault(self._owner, set()).add(self)
 
             #return self._tx
 
@@ -138,9 +162,29 @@ class dynvpn_lock():
                 if self._trace:
                     self._logtrace('lock', f'task {tname} unlocked')
 
+                if (held := dynvpn_lock._held_by.get(self._owner)) is not None:
+                    held.discard(self)
+                    if len(held) == 0:
+                        del dynvpn_lock._held_by[self._owner]
+
                 self.locked_task=None
+                self._owner=None
                 self._lock.release()
 
+    """
+    force-unlock all locks held by the given task
+
+    returns the number of locks released
+    """
+    @classmethod
+    def release_held(cls, task : asyncio.Task) -> int:
+        held=cls._held_by.pop(task, set())
+        for L in held:
+            # already removed from the index above
+            L._owner=None
+            L.unlock(force=True)
+        return len(held)
+
 
     def locked(self):
         return self._lock.locked()
@@ -179,8 +223,15 @@ class vpn_t():
     # a VPN should always be initialized to Pending status
     status : vpn_status_t = vpn_status_t.Pending
 
+    # called with the VPN and its previous status whenever the status changes
+    on_change : Optional[Callable[['vpn_t', vpn_status_t], None]] = field(default=None, repr=False, compare=False)
+
     def set_status(self, s : vpn_status_t):
-        self.status=s
+        if s != self.status:
+            previous_status=self.status
+            self.status=s
+            if self.on_change is not None:
+                self.on_change(self, previous_status)
 
     @staticmethod
     def vname(vpn_id : int) -> str:
@@ -189,6 +240,38 @@ class vpn_t():
         else:
             raise TypeError(f'vname was passed "{vpn_id}" but requires an argument of type int')
 
+    # inverse of vname
+    @staticmethod
+    def vpn_id(vname : str) -> int:
+        if vname.startswith('dynvpn') and vname[len('dynvpn'):].isdigit():
+            return int(vname[len('dynvpn'):])
+        else:
+            raise ValueError(f'vpn_id was passed "{vname}" but requires a name of the form dynvpnN')
+
+    # site_config is the site's entry from the `sites` key in the global.yml config
+    @staticmethod
+    def load(node, site_id, vpn_id, site_config, global_config):
+        vname=vpn_t.vname(int(vpn_id))
+
+        # the ipaddress library already includes support for this operation
+        # TODO catch invalid value / exception
+        anycast_addr=ip_address(global_config['vpn_anycast_addr_base']) + vpn_id
+        local_addr=ip_address(site_config['vpn_local_addr_base']) + vpn_id
+
+        if site_id == node.site_id:
+            L=dynvpn_lock(trace=True, name=vname)
+        else:
+            L=None
+
+        return vpn_t(
+            name=vname,
+            site_id=site_id,
+            local_addr=ip_address(local_addr),
+            anycast_addr=ip_address(anycast_addr),
+            lock=L,
+            on_change=node._vpn_status_changed
+        )
+
 
 @dataclass()
 class site_t():
@@ -218,6 +301,16 @@ class site_t():
     pull_timeout : Optional[int]
     pull_retries : Optional[int]
 
+    # called with the site and its previous status whenever the status changes
+    on_change : Optional[Callable[['site_t', site_status_t], None]] = field(default=None, repr=False, compare=False)
+
+    def set_status(self, s : site_status_t):
+        if s != self.status:
+            previous_status=self.status
+            self.status=s
+            if self.on_change is not None:
+                self.on_change(self, previous_status)
+
     def resolve_vpn_anycast(self, id : str) -> Optional[IPv4Address]:
         try:
             return self.vpn[id].anycast_addr
@@ -242,27 +335,8 @@ class site_t():
         vpns={}
 
         for vpn_id in site_config['vpn']:
-            vname=vpn_t.vname(int(vpn_id))
-
-            # the ipaddress library already includes support for this operation
-            # TODO catch invalid value / exception
-            anycast_addr=ip_address(global_config['vpn_anycast_addr_base']) + vpn_id
-            local_addr=ip_address(site_config['vpn_local_addr_base']) + vpn_id
-
-            if site_id == node.site_id:
-                L=dynvpn_lock(trace=True, name=vname)
-            else:
-                L=None
-
-            vpn_obj=vpn_t(
-                name=vname,
-                site_id=site_id,
-                local_addr=ip_address(local_addr),
-                anycast_addr=ip_address(anycast_addr),
-                lock=L
-            )
-
-            vpns[vname]=vpn_obj
+            vpn_obj=vpn_t.load(node, site_id, vpn_id, site_config, global_config)
+            vpns[vpn_obj.name]=vpn_obj
 
         if site_id != node.local_config['site_id']:
             pull_interval = datetime.timedelta(seconds=node.local_config['pull_interval'])
@@ -282,5 +356,6 @@ class site_t():
             pull_interval=pull_interval,
             pull_timeout=pull_timeout,
             pull_retries=pull_retries,
-            status=site_status_t.Pending
+            status=site_status_t.Pending,
+            on_change=node._site_status_changed
         )
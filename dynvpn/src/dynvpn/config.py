@@ -0,0 +1,72 @@
+import yaml
+
+from typing import Dict, Tuple
+
+local_defaults = {
+
+    'failed_status_timeout': 0,
+
+    'local_vpn_check_interval': 10,
+    'local_vpn_check_timeout': 3,
+    'local_vpn_check_retries': 1,
+    'local_vpn_check_backend': 'script',
+    'local_vpn_check_port': 7777,
+    'local_vpn_check_batch': False,
+    'local_vpn_check_spread': True,
+    'local_vpn_check_jitter': 0.1,
+    'local_check_cache_ttl': 0,
+
+    'online_check_delay': 2,
+
+    'max_concurrent_failovers': 8,
+
+    'cmd_concurrency': 16,
+    'cmd_timeout': 30,
+    'cmd_timeouts': {},
+
+    'ssh_mux': False,
+    'ssh_mux_dir': '/tmp/dynvpn-ssh',
+    'ssh_mux_identity': '~/.ssh/id.openvpn',
+    'ssh_mux_user': 'openvpn',
+    'ssh_mux_reconnect_delay': 5,
+
+    'pull_interval': 30,
+    'pull_timeout': 10,
+    'pull_spread': True,
+    'pull_jitter': 0.1,
+
+    'peer_conn_limit': 4,
+    'peer_keepalive_timeout': 60,
+
+    'broadcast_concurrency': 16,
+    'broadcast_coalesce_delay': 0.2,
+
+    'peer_wire_format': 'binary',
+
+    'replica_mode': 'Manual',
+
+    'snapshot_path': None,
+    'snapshot_max_age': 60,
+    'snapshot_delay': 1,
+
+    'config_watch_interval': 0,
+}
+
+
+"""
+read local.yml and global.yml, filling in defaults for settings missing from local.yml
+
+used at startup and when reloading the configuration (see reload.py)
+"""
+def load_config(local_path : str, global_path : str) -> Tuple[Dict, Dict]:
+    with open(local_path, 'rb') as f:
+        local_config=yaml.safe_load(f)
+
+    with open(global_path, 'rb') as f:
+        global_config=yaml.safe_load(f)
+
+    for k, default in local_defaults.items():
+        if k not in local_config:
+            local_config[k]=default
+
+    return (local_config, global_config)
@@ -3,13 +3,18 @@ import aiohttp
 from aiohttp import web
 import json
 import asyncio
+import hashlib
+import dataclasses
+
+from typing import Dict, List, Tuple
 
 from dynvpn.common import   \
     vpn_status_t, site_status_t, vpn_t,  \
     site_t, str_to_vpn_status_t, replica_mode_t, str_to_replica_mode_t, \
-    json_encoder, dynvpn_exception
+    json_encoder, dynvpn_exception, push_result_t
 
 import dynvpn.processor as processor
+from dynvpn import wire
 
 
 """
@@ -32,24 +37,131 @@ class http_component():
 class client(http_component):
 # TODO singleton
 
-    async def push_state(self, site : site_t, state : str):
+    def __init__(self, node):
+        super().__init__(node)
+
+        # site_id -> aiohttp.ClientSession
+        # one long-lived session per peer, so that pulls, retries and pushes to the same peer
+        # reuse the connector's keep-alive connections instead of connecting each time
+        self._sessions={}
+
+        # IDs of peers which have responded to a pull using the compact format in `wire`, and 
+        # so will also accept it in pushes
+        self._binary_peers=set()
+
+        # site_id -> { vname -> status }, the VPN statuses most recently received from each peer
+        self._peer_view={}
+        # site_id -> digest of the last pull_state response body from each peer, if nothing else 
+        # has changed the peer's VPN statuses in _peer_view since
+        self._peer_digest={}
+
+    """
+    return the pooled session for the given peer, creating it on first use
+
+    sessions must be created from within the running event loop, so they are not created
+    in __init__
+    """
+    def _session(self, site : site_t) -> aiohttp.ClientSession:
+        session=self._sessions.get(site.id)
+        if session is None or session.closed:
+            cfg=self.node.local_config
+            connector=aiohttp.TCPConnector(
+                limit=cfg['peer_conn_limit'],
+                limit_per_host=cfg['peer_conn_limit'],
+                keepalive_timeout=float(cfg['peer_keepalive_timeout']),
+            )
+            session=aiohttp.ClientSession(
+                base_url=f'http://{site.peer_addr}:{site.peer_port}',
+                connector=connector,
+            )
+            self._sessions[site.id]=session
+
+        return session
+
+    """
+    whether to push our state to this peer in the compact format
+    """
+    def binary_supported(self, site : site_t) -> bool:
+        return site.id in self._binary_peers
+
+    """
+    return the (vname, status) pairs from a peer's state which differ from the statuses last 
+    received from that peer, and remember the new statuses
+
+    only these need to be passed on to the processor
+    """
+    def changed_vpns(self, site_id : str, vpns : Dict[str, vpn_status_t]) -> List[Tuple[str, vpn_status_t]]:
+        view=self._peer_view.setdefault(site_id, {})
+        changed=[]
+        for (vname, status) in vpns.items():
+            if view.get(vname) != status:
+                view[vname]=status
+                changed.append( (vname, status) )
+
+        # a pull response identical to the previous one no longer implies that nothing has changed
+        if len(changed) > 0:
+            self._peer_digest.pop(site_id, None)
+
+        return changed
+
+    """
+    forget what we have received from a peer, so that everything in its next state is passed on
+
+    used when the peer's VPNs are marked Offline without the peer telling us
+    """
+    def forget_peer(self, site_id : str):
+        self._peer_view.pop(site_id, None)
+        self._peer_digest.pop(site_id, None)
+
+    """
+    forget a peer which was removed from the configuration, closing its session
+    """
+    async def remove_peer(self, site_id : str):
+        self.forget_peer(site_id)
+        self._binary_peers.discard(site_id)
+        if (session := self._sessions.pop(site_id, None)) is not None and not session.closed:
+            await session.close()
+
+    """
+    close all peer sessions and their pooled connections
+    """
+    async def close(self):
+        sessions=list(self._sessions.values())
+        self._sessions.clear()
+        for session in sessions:
+            if not session.closed:
+                await session.close()
+
+    async def push_state(self, site : site_t, state : bytes) -> push_result_t:
 
         timeout=aiohttp.ClientTimeout(total=float(site.pull_timeout.seconds))
 
+        if self.binary_supported(site):
+            headers={'Content-Type': wire.content_type}
+        else:
+            headers={'Content-Type': 'application/json'}
+
         try:
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with session.post(
-                    f'http://{site.peer_addr}:{site.peer_port}/peer/push_state', 
-                    data=state
-                ) as resp:
+            async with self._session(site).post(
+                '/peer/push_state', 
+                data=state,
+                headers=headers,
+                timeout=timeout
+            ) as resp:
+
+                if resp.status == 200:
+                    return push_result_t.Ok
+                else:
+                    self.node._logger.error(f'error response from {site.id}: {resp.status}: {resp.text}')
 
-                    if resp.status == 200:
-                        return
-                    else:
-                        self.node._logger.error(f'error response from {site.id}: {resp.status}: {resp.text}')
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if isinstance(e, asyncio.TimeoutError):
+                estr='timed out'
+            else:
+                estr=str(e)
+            self.node._logger.warning(f'push_state({site.id}): failed to connect: {estr}') 
 
-        except aiohttp.ClientError as e:
-            self.node._logger.warning(f'push_state({site.id}): failed to connect: {e}') 
+        return push_result_t.Failed
 
     
     async def pull_state(self, site : site_t, handler):
@@ -73,33 +185,58 @@ class client(http_component):
 
             pull_timeout=aiohttp.ClientTimeout(total=site.pull_timeout.seconds)
             try:
-                async with aiohttp.ClientSession(timeout=pull_timeout) as session:
-                    async with session.get(f'http://{site.peer_addr}:{site.peer_port}/peer/pull_state', 
-                        data=json.dumps({'site_id': self.node.site_id})) as resp:
+                req_data={'site_id': self.node.site_id}
+                # ask only for what changed since the last state we received from this peer
+                if site.id in self.node.peer_seq:
+                    (req_data['epoch'], req_data['seq'])=self.node.peer_seq[site.id]
+
+                # offer the compact format; peers which don't support it respond with JSON
+                if self.node.local_config['peer_wire_format'] == 'binary':
+                    headers={'Accept': f'{wire.content_type}, application/json'}
+                else:
+                    headers={'Accept': 'application/json'}
+
+                async with self._session(site).get('/peer/pull_state', 
+                    data=json.dumps(req_data), headers=headers, timeout=pull_timeout) as resp:
 
-                        #self.node._logger.debug(f'pull_state({site.id}): got response {resp.status} from {site.peer_addr}')
+                    #self.node._logger.debug(f'pull_state({site.id}): got response {resp.status} from {site.peer_addr}')
 
-                        if resp.status == 200:
-                            await self.node.handle_site_status(site.id, site_status_t.Online)
+                    if resp.status == 200:
+                        await self.node.handle_site_status(site.id, site_status_t.Online)
 
-                            data=await resp.content.read()
-                            state=self.node._decode_state(data)
-                            state=state['state']
+                        data=await resp.content.read()
 
-                            #for (vpn_id, status) in state['vpn'].items():
-                            for (vpn_id, status) in state[site.id]['vpn'].items():
-                                handler(site.id, vpn_id, status)
+                        if resp.content_type == wire.content_type:
+                            self._binary_peers.add(site.id)
                         else:
-                            await handle_failure()
+                            self._binary_peers.discard(site.id)
+
+                        # most pulls return exactly what the previous one did; skip decoding those
+                        digest=hashlib.blake2b(data, digest_size=16).digest()
+                        if self._peer_digest.get(site.id) == digest:
+                            return
+
+                        decoded=self.node._decode_state(data, resp.content_type)
+                        state=decoded['state']
+
+                        #for (vpn_id, status) in state['vpn'].items():
+                        for (vpn_id, status) in self.changed_vpns(site.id, state[site.id]['vpn']):
+                            handler(site.id, vpn_id, status)
+
+                        self._peer_digest[site.id]=digest
+                        self.node._record_peer_seq(site.id, decoded)
+                        return
 
-                            
             except (aiohttp.ClientError, asyncio.TimeoutError) as e:
                 if isinstance(e, asyncio.TimeoutError):
                     estr='timed out'
                 else:
                     estr=str(e)
                 self.node._logger.warning(f'pull_state({site.id}): failed to connect: {estr}') 
-                await handle_failure()
+
+            # retry outside of the `async with` block, so that the connection is released back 
+            # to the pool before we request another one
+            await handle_failure()
 
         await do_pull()
 
@@ -119,12 +256,22 @@ class server(http_component):
         req_data=json.loads(await request.content.read())
         site_id=req_data['site_id']
 
+        # e.g. while a configuration change is being rolled out to all sites
+        if site_id not in self.node.sites:
+            self.node._logger.warning(f'ignoring pull_state from {request.remote}: site {site_id} is not configured')
+            return { 'error': f'site {site_id} is not configured' }
+
         if self.node.sites[site_id].status != site_status_t.Admin_offline:
             await self.node.handle_site_status(site_id, site_status_t.Online)
-            # for now, encode "the entire" state (no arguments), until we have a more 
-            # sophisticated format for exchanging data between peers
-            #return self.node._encode_state(self.node.site_id)
-            return self.node._encode_state()
+            # peers only use our own site's state; if the peer tells us the last sequence number
+            # it has seen, only the VPNs which changed since are included
+            binary=wire.content_type in request.headers.get('Accept', '')
+            data=self.node._encode_state(self.node.site_id, self.node._pull_since(req_data), binary=binary)
+
+            return aiohttp.web.Response(
+                body=data, 
+                content_type=wire.content_type if binary else 'application/json'
+            )
         else:
             self.node._logger.warning(f'ignoring pull_state from {request.remote}: state is Admin_offline')
 
@@ -132,18 +279,28 @@ class server(http_component):
         self.node._logger.debug(f'received push_state from {request.remote}')
         data=await request.content.read()
         try:
-            state=self.node._decode_state(data)
-        except json.JSONDecodeError as e:
-            self.node._logger.error(f'push_handler: JSONDecodeError: {e} (data={data})')
+            state=self.node._decode_state(data, request.content_type)
+        except ValueError as e:
+            self.node._logger.error(f'push_handler: failed to decode: {e} (data={data})')
+            return { 'error': 'invalid data' }
 
         site_id=state['id']
+        decoded=state
         state=state['state']
 
+        if site_id not in self.node.sites:
+            self.node._logger.warning(f'ignoring push_state from {request.remote}: site {site_id} is not configured')
+            return { 'error': f'site {site_id} is not configured' }
+
         if self.node.sites[site_id].status != site_status_t.Admin_offline:
             await self.node.handle_site_status(site_id, site_status_t.Online)
 
-            for (vpn_id, status) in state[site_id]['vpn'].items():
+            for (vpn_id, status) in self.node.http_client.changed_vpns(site_id, state[site_id]['vpn']):
                 processor.peer_vpn_status_first.instance.add(site_id, vpn_id, status)
+
+            # pushes contain the peer's complete state
+            if not decoded.get('delta', False):
+                self.node._record_peer_seq(site_id, decoded)
         else:
             self.node._logger.warning(f'ignoring push_state from {request.remote}: state is Admin_offline')
 
@@ -194,7 +351,13 @@ class server(http_component):
             await self.node._set_local_vpn_offline(vpn_id)
             await self.node._set_status(vpn_id, vpn_status_t.Offline)
 
-        self.node.sites[self.node.site_id].status=site_status_t.Offline
+        # send any coalesced broadcast before we stop pushing to peers
+        await self.node.broadcaster.flush()
+
+        self.node.sites[self.node.site_id].set_status(site_status_t.Offline)
+
+        # the VPNs were stopped, which a restart can rely on
+        self.node.snapshot.write()
 
     """
     bring the VPN online at the local site, which causes any 
@@ -239,7 +402,7 @@ class server(http_component):
 
     # like pull_state but user-facing instead of peer-facing
     async def node_state_handler(self, request, match):
-        return self.node._encode_state()
+        return self.node._encode_state(pretty=True)
 
     async def debug_state_handler(self, request, match):
         ret={}
@@ -266,6 +429,23 @@ class server(http_component):
                     'cancelling': t.cancelling()
                 })
 
+        ret['task_manager']=self.node.task_manager.stats()
+        ret['startup']=self.node.startup_timing
+        ret['snapshot']=self.node.snapshot.stats()
+        ret['reload']=self.node.reloader.stats()
+        ret['scheduler']={
+            **self.node.scheduler.stats(),
+            'upcoming': self.node.scheduler.upcoming(20),
+            'spread': self.node.scheduler.spread(),
+        }
+        ret['processors']=self.node.processor_stats()
+        ret['commands']=self.node.executor.stats()
+        ret['ssh_mux']=self.node.ssh_mux.stats()
+        ret['local_checks']=self.node.local_checks.stats()
+        ret['probes']={ vname: dataclasses.asdict(r) for vname, r in self.node.last_probe.items() }
+        if self.node.check_batcher is not None:
+            ret['check_batcher']=self.node.check_batcher.stats()
+
         ret['locks']={}
         for vpn_id, vpn in self.node.sites[self.node.site_id].vpn.items():
             ret['locks'][vpn_id]=vpn.lock.get_status()
@@ -283,6 +463,10 @@ class server(http_component):
             
 
 
+    async def reload_config_handler(self, request, match):
+        return await self.node.reloader.reload()
+
+
     async def start(self):
             
         # TODO properly handle 404
@@ -297,10 +481,19 @@ class server(http_component):
         router.add_get('/node_state', self.node_state_handler)
         router.add_get('/debug_state', self.debug_state_handler)
         router.add_post('/set_replica_mode/{value}', self.replica_mode_handler)
+        router.add_post('/reload_config', self.reload_config_handler)
 
         async def handler(request):
             match=await router.resolve(request)
             respdata=await match.handler(request, match)
+
+            if isinstance(respdata, aiohttp.web.Response):
+                return respdata
+
+            # already-encoded state (see node._encode_state) is sent as-is
+            if type(respdata) == bytes:
+                return aiohttp.web.Response(body=respdata, content_type='application/json')
+
             if type(respdata) == str:
                 resptext=respdata
             else:
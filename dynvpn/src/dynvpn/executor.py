@@ -0,0 +1,119 @@
+import asyncio
+import logging
+import os
+import signal
+import time
+
+from typing import Optional, Dict, List, Tuple
+
+"""
+runs our shell scripts for node._cmd
+
+at most `cmd_concurrency` scripts run at the same time; others wait their turn in order. each
+script runs in its own process group, which is killed if the script takes longer than its timeout
+(`cmd_timeouts` for the script's file name, otherwise `cmd_timeout`), or if the calling task is
+cancelled, so that a hung ssh can't hold on to a VPN's lock indefinitely
+
+a script which timed out returns the exit status of the killed process (negative), so callers
+treat it like any other failure
+"""
+
+# upper bounds (seconds) of the histogram buckets in stats
+_buckets=[ 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, float('inf') ]
+
+def _histogram():
+    return [0] * len(_buckets)
+
+def _record(hist : List[int], value : float):
+    for i, bound in enumerate(_buckets):
+        if value <= bound:
+            hist[i] += 1
+            return
+
+class cmd_executor():
+
+    def __init__(self, node, logger : logging.Logger):
+        self.node=node
+        self._logger=logger
+
+        cfg=node.local_config
+        self._concurrency=int(cfg['cmd_concurrency'])
+        self._timeout=float(cfg['cmd_timeout'])
+        # script file name -> timeout
+        self._timeouts : Dict[str, float]={ k: float(v) for k, v in (cfg['cmd_timeouts'] or {}).items() }
+
+        self._sem=asyncio.Semaphore(self._concurrency)
+        self._running=0
+        self._waiting=0
+
+        # script file name -> counters and histograms, see stats
+        self._scripts : Dict[str, Dict]={}
+
+    def timeout(self, script : str) -> float:
+        return self._timeouts.get(script, self._timeout)
+
+    async def run(self, *args, env : Optional[Dict[str, str]]=None) -> Tuple[int, bytes, bytes]:
+        script=os.path.basename(args[0])
+        st=self._scripts.setdefault(script, {
+            'runs': 0,
+            'timeouts': 0,
+            'queue_wait': _histogram(),
+            'runtime': _histogram(),
+        })
+
+        queued=time.monotonic()
+        self._waiting += 1
+        try:
+            await self._sem.acquire()
+        finally:
+            self._waiting -= 1
+
+        try:
+            self._running += 1
+            start=time.monotonic()
+            _record(st['queue_wait'], start - queued)
+
+            proc_obj=await asyncio.create_subprocess_exec(
+                *args,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                env={ **os.environ, **env } if env else None,
+                # so that the script and everything it started can be killed together
+                start_new_session=True,
+            )
+
+            try:
+                stdout, stderr=await asyncio.wait_for(proc_obj.communicate(), self.timeout(script))
+            except TimeoutError:
+                st['timeouts'] += 1
+                _record(st['runtime'], time.monotonic() - start)
+                self._logger.warning(f'cmd_executor: {script} timed out after {self.timeout(script)} seconds, killing {args}')
+                await self._kill(proc_obj)
+                return (proc_obj.returncode, b'', f'timed out after {self.timeout(script)} seconds'.encode())
+            except asyncio.CancelledError:
+                await self._kill(proc_obj)
+                raise
+
+            st['runs'] += 1
+            _record(st['runtime'], time.monotonic() - start)
+            return (proc_obj.returncode, stdout, stderr)
+
+        finally:
+            self._running -= 1
+            self._sem.release()
+
+    async def _kill(self, proc_obj : asyncio.subprocess.Process):
+        try:
+            os.killpg(proc_obj.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        await proc_obj.wait()
+
+    def stats(self):
+        return {
+            'concurrency': self._concurrency,
+            'running': self._running,
+            'waiting': self._waiting,
+            'buckets': [ str(b) for b in _buckets ],
+            'scripts': self._scripts,
+        }
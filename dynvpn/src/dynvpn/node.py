@@ -9,6 +9,8 @@ import traceback
 
 import json
 import datetime
+import time
+import uuid
 
 from typing import Optional, Dict, Tuple, List
 
@@ -19,11 +21,22 @@ import logging
 from dynvpn.common import  \
     vpn_status_t, site_status_t, vpn_t, site_t, str_to_vpn_status_t, \
     replica_mode_t, str_to_replica_mode_t, \
-    dynvpn_lock, dynvpn_exception
+    dynvpn_lock, dynvpn_exception, push_result_t, json_encoder, task_kind_t
 
 import dynvpn.processor as processor
 from dynvpn import dynvpn_http
+from dynvpn import wire
 from dynvpn.task_manager import task_manager
+from dynvpn.broadcast import broadcast_coalescer
+from dynvpn.replica import replica_ring
+from dynvpn.ssh_mux import ssh_mux
+from dynvpn.probe import make_probe, probe_result
+from dynvpn.check_batch import check_batcher
+from dynvpn.scheduler import scheduler
+from dynvpn.executor import cmd_executor
+from dynvpn.singleflight import single_flight
+from dynvpn.snapshot import state_snapshot
+from dynvpn.reload import config_reloader
 
 def log(): 
     pass
@@ -61,7 +74,9 @@ class node():
     replica : Dict[str, List[str]]
 
 
-    def __init__(self, this_site_id : str, local_config, global_config, logger : logging.Logger):
+    # config_files: paths of local.yml and global.yml, for reloading (see reload.py)
+    def __init__(self, this_site_id : str, local_config, global_config, logger : logging.Logger,
+        config_files : Optional[Tuple[str, str]]=None):
 
         self.site_id = this_site_id
         self._logger=logger
@@ -79,11 +94,62 @@ class node():
 
         self.processors=dict()
 
+        # (site_id, since, pretty, binary) -> encoded state, see _encode_state
+        self._state_cache={}
+
+        # vname -> status -> site IDs (as dict keys, kept in insertion order) which have the VPN 
+        #   in that status
+        # maintained by _vpn_status_changed; see _sites_with_vpn_status
+        self._vpn_status_index : Dict[str, Dict[vpn_status_t, Dict[str, None]]]={}
+
+        # vname -> replica_priority compiled into a ring, kept up to date with which sites are
+        #   live replicas (see _replica_live); built below, once sites are loaded
+        self.replica_rings : Dict[str, replica_ring]={}
+
         self.replica_mode=str_to_replica_mode_t(local_config['replica_mode'])
 
+        # versioning of our local state, used so that peers can pull only what changed since their 
+        #   last pull
+        # state_seq is incremented on each change of a local VPN's status; the epoch identifies this 
+        #   run of the instance, since state_seq starts again from 0 after a restart
+        self.state_epoch=uuid.uuid4().hex
+        self.state_seq=0
+        # vname -> value of state_seq when the local VPN's status last changed
+        self._vpn_seq={}
+
+        # site_id -> (epoch, seq) of the most recent complete state we have received from each peer
+        self.peer_seq={}
+
         self.http_client = dynvpn_http.client(self)
         self.http_server = dynvpn_http.server(self)
 
+        self.broadcaster = broadcast_coalescer(self, self._logger)
+
+        # seconds taken by each part of _do_start
+        self.startup_timing : Dict={}
+
+        self.ssh_mux = ssh_mux(self, self._logger)
+
+        # runs the scripts for _cmd
+        self.executor = cmd_executor(self, self._logger)
+
+        # periodic pulls, VPN checks and timeouts
+        self.scheduler = scheduler(self, self._logger)
+
+        # written when statuses change, and loaded here for a warm restart
+        self.snapshot = state_snapshot(self, self._logger)
+
+        self.vpn_probe = make_probe(self, self._logger)
+        # concurrent checks of the same VPN share a single result, see check_local_vpn_*
+        self.local_checks = single_flight(self, self._logger, float(local_config['local_check_cache_ttl']))
+        # vname -> result of the most recent connectivity probe, see check_local_vpn_connectivity
+        self.last_probe : Dict[str, probe_result]={}
+
+        # None unless local_vpn_check_batch is set, see start_check_vpn_task
+        self.check_batcher : Optional[check_batcher]=None
+        if local_config['local_vpn_check_batch']:
+            self.check_batcher=check_batcher(self, self._logger)
+
         self.task_manager.add(
             processor.peer_vpn_status_first(self).start(),
             'peer_vpn_status_first.start'
@@ -94,8 +160,7 @@ class node():
         )
 
         for (site_id, site_config) in sites_config.items():
-            self.sites[site_id]=site_t.load(self, site_id, site_config, global_config)
-            self.sites[site_id].status = site_status_t.Pending
+            self._add_site(site_t.load(self, site_id, site_config, global_config))
 
         if this_site_id not in self.sites:
             raise Exception("local site {this_site_id} not present in site config")
@@ -104,6 +169,23 @@ class node():
         self._server_port=self.sites[this_site_id].peer_port
         self.replica_priority=global_config['replica_priority']
 
+        for vname in self.replica_priority.keys():
+            self._build_replica_ring(vname)
+
+        # set once _do_start has finished
+        self.started=False
+        self.reloader = config_reloader(self, self._logger, config_files)
+
+
+    @property
+    def replica_mode(self) -> replica_mode_t:
+        return self._replica_mode
+
+    @replica_mode.setter
+    def replica_mode(self, mode : replica_mode_t):
+        self._replica_mode=mode
+        self._state_cache.clear()
+
 
     async def start(self):
 
@@ -111,8 +193,14 @@ class node():
             self._do_start(),
             'start'
         )
+        self.task_manager.add(self.scheduler.run(), 'scheduler')
 
-        await self.task_manager.run()
+        try:
+            await self.task_manager.run()
+        finally:
+            self.snapshot.write()
+            await self.http_client.close()
+            await self.ssh_mux.close()
         
 
     """
@@ -122,6 +210,9 @@ class node():
         # make our state available to other peers and listen for push_state
         await self.http_server.start()
 
+        # if enabled, start connecting to the local VPN containers
+        self.ssh_mux.start()
+
         local_vpns=self.sites[self.site_id].vpn.keys()
 
         vs=vpn_status_t
@@ -137,20 +228,37 @@ class node():
             await vpn.lock.lock()
 
         def currently_online(vname):
-            return list(filter(lambda s: 
-                s.id != self.site_id and \
-                vname in s.vpn and \
-                s.vpn[vname].status == vpn_status_t.Online, 
-            self.sites.values()))
+            return [ 
+                site_id for site_id in self._sites_with_vpn_status(vname, vpn_status_t.Online) 
+                if site_id != self.site_id
+            ]
 
         # at this point, all local VPNs' states have been initialized to Pending
 
         phase1_online=set()
 
+        # local VPNs whose process was stopped as of a recent snapshot
+        snapshot_stopped=set()
+
+        # with a recent snapshot, our first pulls only need what changed since
+        self.snapshot.restore_peers()
+
 
         # first pass - check for local VPNs with existing online connections
         async def phase1(vname):
 
+            # skip checking the container if a recent snapshot tells us what we would find
+            match self.snapshot.local_status(vname):
+                case vs.Online:
+                    # checked again if it's kept online (see vpn_online)
+                    self._logger.info(f'start(): {vname}: Online in snapshot, assuming process exists')
+                    phase1_online.add(vname)
+                    return
+                case vs.Replica | vs.Offline | vs.Failed as s:
+                    self._logger.info(f'start(): {vname}: {s} in snapshot, assuming no process')
+                    snapshot_stopped.add(vname)
+                    return
+
             if await self.check_local_vpn_process(vname):
                 self._logger.info(f'start(): {vname}: process exists at startup, checking connectivity')
                 if await self.check_local_vpn_connectivity(vname):
@@ -230,7 +338,8 @@ class node():
                     pass
             else:
                 # peer has come Online first / was already Online when we started
-                if await self.check_local_vpn_connectivity(vname) or await self.check_local_vpn_process(vname):
+                if vname not in snapshot_stopped and \
+                    (await self.check_local_vpn_connectivity(vname) or await self.check_local_vpn_process(vname)):
                     self._logger.info(f'start(): {vname}: peer is already online, stopping our connection')
                     await self._set_local_vpn_offline(vname)
 
@@ -243,40 +352,105 @@ class node():
             if self.get_local_vpn(vname).status in [ vs.Offline, vs.Pending ]:
                 await set_replica_or_offline(vname)
 
-        await self.task_manager.iter_add_wait(local_vpns, phase1, 'start-phase1')
+        # each VPN goes through the phases on its own, rather than all VPNs finishing a phase before
+        #   any starts the next
+        # phase1 only looks at the local container, so it runs while we pull from our peers; the 
+        #   later phases need the state of the network, so they wait until the pulls are done
+        start=time.monotonic()
+        view_ready=asyncio.Event()
+        self.startup_timing={ 'pulls': {}, 'vpns': {} }
 
         # for nodes which are already established, we will get an idea of the state of the network before taking
         #   any action.
-        for (site_id, site) in self.sites.items():
-            if site_id != self.site_id:
-                await self.pull_state(site_id)
+        async def pull(site_id):
+            t=time.monotonic()
+            await self.pull_state(site_id)
+            self.startup_timing['pulls'][site_id]=time.monotonic() - t
+
+        async def pull_peers():
+            peers=[ site_id for site_id in self.sites if site_id != self.site_id ]
+            await self.task_manager.iter_add_wait(peers, pull, 'start-pull')
+
+            # the pulled statuses are recorded by peer_vpn_status_first
+            await processor.peer_vpn_status_first.instance.idle.wait()
+            self.startup_timing['view_ready']=time.monotonic() - start
+            view_ready.set()
+
+        async def wait_view(vname):
+            await view_ready.wait()
+
+        async def pipeline(vname):
+            timing=self.startup_timing['vpns'][vname]={}
+            t=time.monotonic()
+
+            for (name, phase) in [ ('phase1', phase1), ('wait_view', wait_view), 
+                ('phase2', phase2), ('phase3', phase3), ('phase4', phase4) ]:
+
+                await phase(vname)
+                now=time.monotonic()
+                timing[name]=now - t
+                t=now
+
+            timing['total']=sum(timing.values())
+            self._logger.info(
+                f'start(): {vname}: {self.get_local_vpn(vname).status} after {timing["total"]:.3f}s ('
+                + ', '.join(f'{name}={d:.3f}s' for (name, d) in timing.items() if name != 'total') + ')'
+            )
+
+        pulls=self.task_manager.add(pull_peers(), 'start-pull-peers')
+        await self.task_manager.iter_add_wait(local_vpns, pipeline, 'start')
+        await pulls
 
-        await self.task_manager.iter_add_wait(local_vpns, phase2, 'start-phase2')
-        await self.task_manager.iter_add_wait(local_vpns, phase3, 'start-phase3')
-        await self.task_manager.iter_add_wait(local_vpns, phase4, 'start-phase4')
+        # apply any statuses which peers pushed to us during startup before acting on updates
+        await processor.peer_vpn_status_first.instance.idle.wait()
 
-        await asyncio.sleep(1)
+        self.startup_timing['total']=time.monotonic() - start
+        self._logger.info(f'start(): startup took {self.startup_timing["total"]:.3f}s (cluster view after {self.startup_timing["view_ready"]:.3f}s)')
 
         for vpn in self.sites[self.site_id].vpn.values():
             vpn.lock.unlock()
         processor.peer_vpn_status_second.instance.activate()
         processor.peer_vpn_status_second.instance.set_discard(False)
 
-        for (site_id, _) in self.sites.items():
-            if site_id != self.site_id:
-                self.task_manager.add(self.pull_state_task(site_id), f'{site_id}_pull-state')
+        self._schedule_pulls()
 
+        self.started=True
+        self.reloader.start()
 
 
-    async def pull_state_task(self, site_id):
-        try:
-            while True:
-                if self.sites[self.site_id].status == site_status_t.Offline:
-                    self._logger.info('pull_state_task: detected local site Offline, exiting')
-                    return
+    """
+    (re)schedule the periodic pull from each peer
+    """
+    def _schedule_pulls(self):
+        # with pull_spread, pulls from each peer are given their own phase of the interval, evenly 
+        #   spaced, instead of all happening together
+        peers=[ site_id for site_id in self.sites if site_id != self.site_id ]
+        for (i, site_id) in enumerate(peers):
+            interval=float(self.sites[site_id].pull_interval.seconds)
+            if self.local_config['pull_spread']:
+                (delay, phase)=(0, i / len(peers))
+            else:
+                (delay, phase)=(interval, None)
+
+            self.scheduler.schedule(
+                f'{site_id}_pull-state',
+                functools.partial(self.pull_state_task, site_id),
+                delay, interval,
+                jitter=float(self.local_config['pull_jitter']) * interval,
+                phase=phase
+            )
+
 
-                await asyncio.sleep(float(self.sites[site_id].pull_interval.seconds))
-                await self.pull_state(site_id)
+    """
+    run periodically by the scheduler for each peer
+    """
+    async def pull_state_task(self, site_id) -> Optional[bool]:
+        if self.sites[self.site_id].status == site_status_t.Offline:
+            self._logger.info('pull_state_task: detected local site Offline, exiting')
+            return False
+
+        try:
+            await self.pull_state(site_id)
         except Exception as e:
             print(e)
             # TODO check that this shows the KeyError
@@ -284,35 +458,55 @@ class node():
 
     async def start_check_vpn_task(self, vname, iter=None) -> None:
 
-        async def f(vname, iter):
-            while iter is None or (iter := iter-1) >= 0:
-                
-                if self.get_local_vpn(vname).status not in  [ vpn_status_t.Online, vpn_status_t.Pending ]:
-                    # the VPN may have been manually set offline locally
-                    self._logger.info(f'check_vpn_task({vname}): VPN is not Online or Pending, exiting task')
-                    return
+        # run periodically by the scheduler, until the VPN fails or isn't Online or Pending anymore
+        async def f():
+            nonlocal iter
+            if iter is not None and (iter := iter-1) < 0:
+                return False
 
-                await asyncio.sleep(float(self.local_config['local_vpn_check_interval']))
+            if self.get_local_vpn(vname).status not in  [ vpn_status_t.Online, vpn_status_t.Pending ]:
+                # the VPN may have been manually set offline locally
+                self._logger.info(f'check_vpn_task({vname}): VPN is not Online or Pending, exiting task')
+                return False
+
+            if self.check_batcher is not None:
+                # checked together with the other Online VPNs, in the same round
+                result=await self.check_batcher.check(vname)
+            else:
                 result=await self.check_local_vpn_connectivity(vname)
 
-                if result == False:
-                    self._logger.info(f'check_vpn_task({vname}): failure detected, initiating retries')
-                    
-                    self.task_manager.add(
-                        self.failure_retry(vname, retries=self.local_config['failure_retries']),
-                        f'failure_retry({vname})'
-                    )
-                    return
+            if result == False:
+                self._logger.info(f'check_vpn_task({vname}): failure detected, initiating retries')
+                
+                self.task_manager.add(
+                    self.failure_retry(vname, retries=self.local_config['failure_retries']),
+                    f'failure_retry({vname})',
+                    vname, task_kind_t.Failure_retry
+                )
+                return False
 
-        name=f'check-vpn_{vname}'
-        if self.task_manager.find(name) != None:
+        if f'check-vpn_{vname}' in self.scheduler:
             self._logger.warning(f'start_check_vpn_task: task exists for {vname}')
             return
 
         self._logger.debug(f'start_check_vpn_task: starting task for {vname}')
-        self.task_manager.add(
-            f(vname, iter), 
-            name
+        interval=float(self.local_config['local_vpn_check_interval'])
+        jitter=float(self.local_config['local_vpn_check_jitter']) * interval
+
+        if self.check_batcher is not None:
+            # all VPNs are checked together, see check_batcher
+            (delay, phase, jitter)=(0, 0.0, 0.0)
+        elif self.local_config['local_vpn_check_spread']:
+            # each local VPN has its own phase of the interval, evenly spaced
+            local_vpns=list(self.sites[self.site_id].vpn.keys())
+            (delay, phase)=(0, local_vpns.index(vname) / len(local_vpns))
+        else:
+            (delay, phase)=(interval, None)
+
+        self.scheduler.schedule(
+            f'check-vpn_{vname}', f, delay, interval,
+            jitter=jitter, phase=phase,
+            vname=vname, kind=task_kind_t.Check_vpn
         )
 
     """
@@ -321,9 +515,8 @@ class node():
     async def stop_check_vpn_task(self, vname : str) -> bool:
         vs=vpn_status_t
 
-        if (t := self.task_manager.find(f'check-vpn_{vname}')) is not None:
-            self._logger.debug(f'vpn_offline({vname}): canceled check-vpn task {t.get_name()}')
-            t.cancel()
+        if self.scheduler.cancel(f'check-vpn_{vname}'):
+            self._logger.debug(f'vpn_offline({vname}): canceled check-vpn task check-vpn_{vname}')
             return True
         else:
             if self.get_local_vpn(vname).status == vs.Online:
@@ -333,13 +526,23 @@ class node():
     """
     """
     def stop_retries(self, vname : str):
-        ts=self.task_manager.list()
-        for tname in ts:
-            if tname.startswith(f'failure_retry({vname})') and tname != asyncio.current_task().get_name():
-                t = self.task_manager.find(tname)
+        self.scheduler.cancel(f'failed-timeout_{vname}')
+
+        current=asyncio.current_task()
+        for t in self.task_manager.find_vpn(vname, task_kind_t.Failure_retry):
+            if t is not current:
                 t.cancel()
 
 
+    """
+    queue depth and wait time for each lane of each processor
+    """
+    def processor_stats(self):
+        return {
+            type(p).__name__: p.stats() 
+            for p in [ processor.peer_vpn_status_first.instance, processor.peer_vpn_status_second.instance ]
+        }
+
     def get_local_vpn(self, vname : str):
         try:
             return self.sites[self.site_id].vpn[vname]
@@ -357,28 +560,65 @@ class node():
     Used by any part of the program to update the status of a local VPN (e.g. when coming online
     or failing). 
     
-    Unless broadcast=False, it will trigger an update to all peers
+    Unless broadcast=False, it will trigger an update to all peers. Updates are coalesced with
+    other status changes made shortly afterwards, except for Failed and Offline, which cause peers
+    to fail over and so are sent immediately
     """
     async def _set_status(self, vname : str, s : vpn_status_t, broadcast=True):
-        self.sites[self.site_id].vpn[vname].set_status(s)
+        vpn=self.sites[self.site_id].vpn[vname]
+        if vpn.status != s:
+            self.state_seq += 1
+            self._vpn_seq[vname]=self.state_seq
+
+        vpn.set_status(s)
         if broadcast:
-            await self.broadcast_state()
+            if s in [ vpn_status_t.Failed, vpn_status_t.Offline ]:
+                await self.broadcaster.flush()
+            else:
+                await self.broadcaster.request()
         
         return True
 
 
     """
-    call push_state on all peers
+    call push_state on all peers concurrently, with at most `broadcast_concurrency` pushes
+    in flight at once
+
+    each push is bounded by the peer's pull_timeout, so a slow or unreachable peer does not 
+    delay the update reaching the others
+
+    returns the outcome of the push for each peer
     """
-    async def broadcast_state(self):
-        for (id, _) in self.sites.items():
-            if id != self.site_id: 
-                await self.push_state(id)
+    async def broadcast_state(self) -> Dict[str, push_result_t]:
+        peers=[ id for id in self.sites.keys() if id != self.site_id ]
+        sem=asyncio.Semaphore(self.local_config['broadcast_concurrency'])
+
+        async def push(site_id):
+            async with sem:
+                return await self.push_state(site_id)
+
+        started=time.monotonic()
+        results=await asyncio.gather(*[ push(id) for id in peers ], return_exceptions=True)
+        elapsed=time.monotonic() - started
+
+        outcomes={}
+        for site_id, r in zip(peers, results):
+            if isinstance(r, Exception):
+                self._logger.error(f'broadcast_state: push_state({site_id}) raised exception: {r}')
+                r=push_result_t.Failed
+            outcomes[site_id]=r
+
+        self._logger.debug(
+            f'broadcast_state: {len(peers)} peers in {elapsed*1000:.1f}ms: '
+            + ', '.join([ f'{site_id}={r}' for site_id, r in outcomes.items() ])
+        )
+
+        return outcomes
 
     """
     send a copy of our state to a peer when there's a change
     """
-    async def push_state(self, site_id : str):
+    async def push_state(self, site_id : str) -> push_result_t:
         try:
             site=self.sites[site_id]
 
@@ -387,13 +627,16 @@ class node():
             # or it will be detected by the site calling pull_state on us
             if site.status == site_status_t.Offline:
                 self._logger.info(f'push_state({site_id}): site is offline, skipping')
-                return
+                return push_result_t.Skipped
 
-            await self.http_client.push_state(site, self._encode_state(self.site_id))
+            return await self.http_client.push_state(site, 
+                self._encode_state(self.site_id, binary=self.http_client.binary_supported(site))
+            )
 
 
         except KeyError:
             self._logger.error('push_state: unknown peer {site_id}')
+            return push_result_t.Failed
 
     """
     check that a peer is online, and save their state
@@ -494,7 +737,8 @@ class node():
             self.task_manager.add(
                 # retries is decremented in failure_retry
                 self.failure_retry(vname, broadcast=broadcast, retries=retries),
-                f'failure_retry({vname}) retries={retries}'
+                f'failure_retry({vname}) retries={retries}',
+                vname, task_kind_t.Failure_retry
             )
 
         return success
@@ -544,11 +788,7 @@ class node():
             # if we're set to Replica, check if we need to come Online
             # TODO in the future, better to have an event listener or to run these updates through a `processor`
             currently_online= \
-                list(filter(lambda site_id: 
-                    site_id != self.site_id and  \
-                    self.sites[site_id].status == site_status_t.Online and \
-                    self.sites[site_id].vpn[vname].status == vs.Online,
-                self.sites.keys()))
+                [ site_id for site_id in self._find_sites(vname, [ vs.Online ]) if site_id != self.site_id ]
             if len(currently_online) == 0:
 
                 self._logger.error(f'vpn_offline({vname}): from Replica, setting Online since no peers Online')
@@ -575,7 +815,7 @@ class node():
     """
     def _replica_configured(self, vname : str):
         try:
-            if self.site_id in self.replica_priority[vname]:
+            if self.site_id in self.replica_rings[vname]:
                 return True
             else:
                 return False
@@ -583,43 +823,54 @@ class node():
             self._logger.warning(f'_replica_configured({vname}): VPN not present in priority list')
 
     """
-    return number of indices which separate sites s1 and s2 in the replica list for vname
-    positive if s1 has higher replica priority than s2, otherwise negative
-        except: if s1 is last in the list and s2 is first, return 1 (as if s2 follows directly after s1)
+    return number of indices which separate sites s1 and s2 in the replica list for vname, 
+    along with the list (see replica_ring.distance)
 
-    return None if 
+    return None if the VPN is not in the replica list
     """
-    def _replica_distance(self, s1, s2, vname,  
-        site_state_restrict : List[vpn_status_t] = [site_status_t.Online],
-        vpn_state_restrict : List[vpn_status_t] = [vpn_status_t.Replica]
-    ) -> Optional[int]:
-        rp=self._find_sites(vname, vpn_state_restrict, site_state_restrict)
-        
-        if vname in self.replica_priority:
-            rp=self.replica_priority[vname]
-        else:
-            self._logger.debug(f'find_sites returning None because {vname} is not in RP list')
+    def _replica_distance(self, s1, s2, vname) -> Optional[Tuple[Optional[int], List[str]]]:
+        if (ring := self.replica_rings.get(vname)) is None:
+            self._logger.debug(f'_replica_distance returning None because {vname} is not in RP list')
             return None
 
-        def f():
-            try:
-                p1=rp.index(s1)
-                p2=rp.index(s2)
+        d=ring.distance(s1, s2)
+        if d is None:
+            self._logger.error(f'_replica_distance: {s1} or {s2} not in replica list for {vname}')
 
-                if p1 == len(rp) - 1 and p2 == 0:
-                    return 1
-                else:
-                    return p2 - p1
-            except ValueError as e:
-                self._logger.error(f'_replica_distance encountered ValueError: {e}')
-                return None
-            except KeyError:
-                return None
-        
-        return (f(), rp)
+        return (d, ring.order)
+
+    """
+    the site which should attempt to bring the VPN online when it fails at `site_id`: the first
+    live replica following `site_id` in the replica list (see README.md)
+
+    None if there is no such site, or if the VPN is not in the replica list
+    """
+    def _failover_successor(self, site_id : str, vname : str) -> Optional[str]:
+        if (ring := self.replica_rings.get(vname)) is None:
+            return None
+        return ring.live_successor(site_id)
+
+    """
+    a site other than `site_id` where the VPN is Online or being brought online (Pending), and which 
+    is Online itself (or is the local site); None if there is no such site
+    """
+    def _serving_elsewhere(self, vname : str, site_id : str) -> Optional[str]:
+        for status in [ vpn_status_t.Online, vpn_status_t.Pending ]:
+            for s_id in self._sites_with_vpn_status(vname, status):
+                if s_id != site_id and (s_id == self.site_id or self.sites[s_id].status == site_status_t.Online):
+                    return s_id
+        return None
 
-        # TODO error log
+    """
+    whether the site's copy of the VPN is a replica which can take part in failover: in Replica 
+    status, at a site which is Online (or at the local site)
+    """
+    def _replica_live(self, site_id : str, vname : str) -> bool:
+        if (site := self.sites.get(site_id)) is None or vname not in site.vpn:
+            return False
 
+        return site.vpn[vname].status == vpn_status_t.Replica and \
+            (site_id == self.site_id or site.status == site_status_t.Online)
 
     """
     find an online site which is configured for the specified VPN, and which also satisfied the specified condition
@@ -632,32 +883,42 @@ class node():
         site_state_restrict : List[vpn_status_t] = [site_status_t.Online],
     ) -> List[str]:
 
-        
-        ret=[]
+        if len(vpn_state_restrict) > 0:
+            candidates=[ 
+                site_id for status in vpn_state_restrict 
+                for site_id in self._sites_with_vpn_status(vname, status)
+            ]
+        else:
+            candidates=[ site_id for site_id, site in self.sites.items() if vname in site.vpn ]
 
-        for site_id, site in self.sites.items():
-            if site_id not in self.sites:
-                self._logger.warning(f'find_sites: site {site_id} not configured locally')
-                continue
+        ret=[]
 
+        for site_id in candidates:
+            site_status=self.sites[site_id].status
             if \
-                self.sites[site_id].status == site_status_t.Online and \
-                vname in self.sites[site_id].vpn and \
+                site_status == site_status_t.Online and \
                 ( 
-                    self.sites[site_id].status in site_state_restrict
+                    site_status in site_state_restrict
                         if len(site_state_restrict) > 0
                         else True
-                ) \
-                and ( 
-                    self.sites[site_id].vpn[vname].status in vpn_state_restrict 
-                        if len(vpn_state_restrict) > 0
-                        else True
                 ):
 
                 ret.append(site_id)
 
         return ret
 
+    """
+    IDs of all sites which have the given VPN in the given status, regardless of site status
+    """
+    def _sites_with_vpn_status(self, vname : str, status : vpn_status_t):
+        return self._vpn_status_index.get(vname, {}).get(status, {}).keys()
+
+    def _index_vpn_status(self, vpn : vpn_t, previous_status : Optional[vpn_status_t]):
+        by_status=self._vpn_status_index.setdefault(vpn.name, {})
+        if previous_status is not None:
+            by_status.get(previous_status, {}).pop(vpn.site_id, None)
+        by_status.setdefault(vpn.status, {})[vpn.site_id]=None
+
     def _local_vpn_obj(self, vname : str):
         try:
             return self.sites[self.site_id].vpn[vname]
@@ -665,36 +926,235 @@ class node():
             self._logger.error(f'local VPN not found: {vname}')
             return None
 
-    # convert state to JSON
-    # used for transmission of our state to a peer, or for dumping state on all peers to a client
+    # build a dict of our view of the state, with enum values
     # if site_id is None, include all sites
-    def _encode_state(self, site_id=None):
+    #
+    # if `since` is given, only include local VPNs whose status changed after that value of 
+    #   state_seq (a "delta"); peers only need our own site's state, so this is only meaningful
+    #   with site_id=self.site_id
+    def _state_dict(self, site_id=None, since : Optional[int]=None) -> Dict:
         def site_state(site_id):
+            vpns=self.sites[site_id].vpn.items()
+            if since is not None:
+                vpns=[ (vname, v) for (vname, v) in vpns if self._vpn_seq.get(vname, 0) > since ]
+
             return dict({
                 'id': site_id,
                 'vpn': {
-                    vname: str(v.status) for (vname, v) in self.sites[site_id].vpn.items()
+                    vname: v.status for (vname, v) in vpns
                 }
             })
 
-        #if site_id is None:
-        #    ret={
-        #        s_id: site_state(s_id) for s_id, s in self.sites.items()
-        #    }
-        #else:
-        #    ret=site_state(self.site_id)
+        if site_id is None:
+            site_ids=self.sites.keys()
+        else:
+            site_ids=[ site_id ]
 
-        state={
+        return {
             'id': self.site_id,
-            'replica_mode': str(self.replica_mode),
+            'replica_mode': self.replica_mode,
+            'epoch': self.state_epoch,
+            'seq': self.state_seq,
+            'delta': since is not None,
             'state': {
-                s_id: site_state(s_id) for s_id, s in self.sites.items()
+                s_id: site_state(s_id) for s_id in site_ids
             }
         }
 
-        return json.dumps(state, indent=4)
+    # encode state (see _state_dict) to JSON, or to the compact format in `wire` if binary=True
+    # used for transmission of our state to a peer, or for dumping state on all peers to a client
+    #
+    # the encoded bytes are cached until the state they contain changes (see _invalidate_state),
+    #   so repeated pulls and pushes of an unchanged state are not re-encoded
+    # pretty=True is for user-facing output only; peers get compact JSON
+    def _encode_state(self, site_id=None, since : Optional[int]=None, pretty=False, binary=False) -> bytes:
+        key=(site_id, since, pretty, binary)
+        if (data := self._state_cache.get(key)) is not None:
+            return data
+
+        state=self._state_dict(site_id, since)
+
+        if binary:
+            data=wire.encode_state(state)
+        elif pretty:
+            data=(json.dumps(state, indent=4, cls=json_encoder) + "\n").encode('utf-8')
+        else:
+            data=json.dumps(state, separators=(',', ':'), cls=json_encoder).encode('utf-8')
+
+        self._state_cache[key]=data
+        return data
+
+    """
+    drop cached encodings of the state which include the given site's status or VPN statuses
+    """
+    def _invalidate_state(self, site_id : str):
+        for key in list(self._state_cache.keys()):
+            if key[0] is None or key[0] == site_id:
+                del self._state_cache[key]
+
+    """
+    compile the VPN's replica_priority into a ring, replacing any existing ring
+    """
+    def _build_replica_ring(self, vname : str):
+        ring=self.replica_rings[vname]=replica_ring(vname, self.replica_priority[vname])
+        for site_id in ring.order:
+            ring.set_live(site_id, self._replica_live(site_id, vname))
+
+    """
+    add a VPN object to a site, see reload.py
+    """
+    def _add_vpn(self, site_id : str, vpn : vpn_t):
+        self.sites[site_id].vpn[vpn.name]=vpn
+        self._index_vpn_status(vpn, None)
+        if (ring := self.replica_rings.get(vpn.name)) is not None:
+            ring.set_live(site_id, self._replica_live(site_id, vpn.name))
+        self._invalidate_state(site_id)
+
+    """
+    remove a VPN from a site, and from the indexes which refer to it
+    for a local VPN, it should already have been stopped (see _retire_local_vpn)
+    """
+    def _remove_vpn(self, site_id : str, vname : str):
+        vpn=self.sites[site_id].vpn.pop(vname)
+
+        if (by_status := self._vpn_status_index.get(vname)) is not None:
+            by_status.get(vpn.status, {}).pop(site_id, None)
+            if all(len(sites) == 0 for sites in by_status.values()):
+                del self._vpn_status_index[vname]
+
+        if (ring := self.replica_rings.get(vname)) is not None:
+            ring.set_live(site_id, False)
+
+        if site_id == self.site_id:
+            self._vpn_seq.pop(vname, None)
+            self.last_probe.pop(vname, None)
+            self.local_checks.forget(vname)
+            self.ssh_mux.remove(vname)
+
+        self._invalidate_state(site_id)
+
+    def _add_site(self, site : site_t):
+        self.sites[site.id]=site
+        site.set_status(site_status_t.Pending)
+        for vpn in site.vpn.values():
+            self._add_vpn(site.id, vpn)
+
+    """
+    stop pulling from a peer and forget everything about it
+    """
+    async def _remove_site(self, site_id : str):
+        self.scheduler.cancel(f'{site_id}_pull-state')
+
+        for vname in list(self.sites[site_id].vpn.keys()):
+            self._remove_vpn(site_id, vname)
+
+        del self.sites[site_id]
+        self.peer_seq.pop(site_id, None)
+        self._invalidate_state(site_id)
+        await self.http_client.remove_peer(site_id)
+
+    """
+    bring a VPN which was added to the local site while running into the state it would have had 
+    after startup: Online if we are first in its replica list and no peer has it Online, otherwise 
+    Replica or Offline
+    """
+    async def _start_local_vpn(self, vname : str):
+        vs=vpn_status_t
+        vpn=self.get_local_vpn(vname)
+
+        await vpn.lock.lock()
+        try:
+            currently_online=[ 
+                site_id for site_id in self._sites_with_vpn_status(vname, vs.Online) if site_id != self.site_id
+            ]
+            rp=self.replica_priority.get(vname)
+
+            if len(currently_online) == 0 and rp is not None and rp[0] == self.site_id:
+                self._logger.info(f'_start_local_vpn({vname}): first in priority list, with no peers in Online state - setting online')
+                await self.vpn_online(vname, timeout_throw=False, lock=False)
+            else:
+                if await self.check_local_vpn_process(vname):
+                    await self._set_local_vpn_offline(vname)
+
+                if self.replica_mode == replica_mode_t.Auto and self._replica_configured(vname):
+                    await self._set_status(vname, vs.Replica)
+                else:
+                    await self._set_status(vname, vs.Offline)
+        finally:
+            vpn.lock.unlock()
+
+    """
+    stop a VPN which was removed from the local site while running, telling peers it's Offline,
+    then remove it
+
+    peers only fail the VPN over if it was Online (or Pending) here, see peer_vpn_status_second;
+    retiring a Replica doesn't move the VPN away from the site where it's Online
+    """
+    async def _retire_local_vpn(self, vname : str):
+        await self.vpn_offline(vname, True)
+        self.stop_retries(vname)
+        # send Offline before peers stop hearing about the VPN from us
+        await self.broadcaster.flush()
+        self._remove_vpn(self.site_id, vname)
+
+
+    # called by vpn_t when its status changes
+    def _vpn_status_changed(self, vpn : vpn_t, previous_status : vpn_status_t):
+        self._index_vpn_status(vpn, previous_status)
+        if (ring := self.replica_rings.get(vpn.name)) is not None:
+            ring.set_live(vpn.site_id, self._replica_live(vpn.site_id, vpn.name))
+        self._invalidate_state(vpn.site_id)
+        self.snapshot.request()
+
+    # called by site_t when its status changes
+    def _site_status_changed(self, site : site_t, previous_status : site_status_t):
+        for vname in site.vpn.keys():
+            if (ring := self.replica_rings.get(vname)) is not None:
+                ring.set_live(site.id, self._replica_live(site.id, vname))
+        self._invalidate_state(site.id)
+        self.snapshot.request()
+
+    """
+    given the request body of a peer's pull_state, return the value of `since` to pass to 
+    _encode_state, or None if the peer needs a full copy of our state
+
+    the peer gets a full copy if it has never pulled from us, if it last pulled from a previous
+    run of this instance, or if it has otherwise has a sequence number we don't recognize
+    """
+    def _pull_since(self, req_data : Dict) -> Optional[int]:
+        seq=req_data.get('seq')
+        if req_data.get('epoch') != self.state_epoch or not isinstance(seq, int):
+            return None
+        if seq < 0 or seq > self.state_seq:
+            return None
+        return seq
+
+    """
+    record the sequence number of a decoded state received from a peer (push or pull), so that
+    our next pull from the peer only needs to return what changed since
+    """
+    def _record_peer_seq(self, site_id : str, state : Dict):
+        epoch=state.get('epoch')
+        seq=state.get('seq')
+
+        # peer is running an older version without sequence numbers
+        if epoch is None or not isinstance(seq, int):
+            self.peer_seq.pop(site_id, None)
+            return
+
+        if site_id in self.peer_seq:
+            (prev_epoch, prev_seq)=self.peer_seq[site_id]
+            if prev_epoch == epoch and prev_seq > seq:
+                return
+
+        self.peer_seq[site_id]=(epoch, seq)
+
+    # decode state received from a peer, in JSON or the compact format depending on content_type
+    # raises ValueError if the data can't be decoded
+    def _decode_state(self, data : bytes, content_type : Optional[str]=None) -> Dict:
+        if content_type == wire.content_type:
+            return wire.decode_state(data)
 
-    def _decode_state(self, data : str) -> Dict:
         d=json.loads(data)
 
         try:
@@ -707,7 +1167,7 @@ class node():
 
             return d
         except KeyError:
-            self._logger.error(f'_decode_state failed: invalid data: %s' % data.encode('utf-8'))
+            self._logger.error(f'_decode_state failed: invalid data: %s' % data)
             return None
 
 
@@ -723,11 +1183,16 @@ class node():
 
         site=self.sites[site_id]
         previous_status=site.status
-        site.status=status
+        site.set_status(status)
         self._logger.debug(f'handle_site_status({site_id}): {previous_status} -> {status}')
 
         match (previous_status, status):
             case (ss.Pending, ss.Offline) | (ss.Online, ss.Offline) | (_, ss.Admin_offline):
+                # we are about to mark all the site's VPNs Offline, so the next pull needs
+                # a full copy of the peer's state rather than only the changes
+                self.peer_seq.pop(site_id, None)
+                self.http_client.forget_peer(site_id)
+
                 for (vname, _) in site.vpn.items():
                     # count this as a "pull" for the purpose of 
                     processor.peer_vpn_status_first.instance.add(site_id, vname, vpn_status_t.Offline)
@@ -782,32 +1247,47 @@ class node():
             if 'failed_status_timeout' in self.local_config else 0
 
         if timeout > 0:
-            while True:
-                # eventually clear our Failed status, since underlying conditions may have changed
-                # currently we only do this if a peer has brought the VPN online 
-                await asyncio.sleep(timeout)
+            # eventually clear our Failed status, since underlying conditions may have changed
+            # cancelled by stop_retries
+            self.scheduler.schedule(
+                f'failed-timeout_{vname}',
+                functools.partial(self.failed_status_timeout, vname),
+                timeout, timeout,
+                vname=vname, kind=task_kind_t.Failure_retry
+            )
 
-                for _, site in self.sites.items():
-                    if site.id == self.site_id:
-                        # this should not happen; if it's manually set to Online or Offline locally while we were 
-                        # sleeping, our task would have been canceled
-                        if site.vpn[vname].status != vs.Failed:
-                            self._logger.warning('failure_retry({vname}): status changed to {site.vpn[vname].status}')
-                            return
-                        else:
-                            continue
+    """
+    run by the scheduler every failed_status_timeout seconds while a local VPN is Failed
+    currently we only clear the Failed status if a peer has brought the VPN online 
+    """
+    async def failed_status_timeout(self, vname : str) -> Optional[bool]:
+        vs=vpn_status_t
+        vpn = self.get_local_vpn(vname)
+
+        await vpn.lock.lock()
+
+        # this should not happen; if it's manually set to Online or Offline locally while we were 
+        # waiting, we would have been canceled
+        if vpn.status != vs.Failed:
+            self._logger.warning(f'failure_retry({vname}): status changed to {vpn.status}')
+            vpn.lock.unlock()
+            return False
+
+        for site_id in self._sites_with_vpn_status(vname, vpn_status_t.Online):
+            if site_id != self.site_id:
+                if self.replica_mode == replica_mode_t.Auto:
+                    s=vpn_status_t.Replica
+                
+                # TODO possibly questionable - if we were in Replica state to begin with, it might
+                # be best if we return to that
+                else:
+                    s=vpn_status_t.Offline
 
-                    if vname in site.vpn and site.vpn[vname].status == vpn_status_t.Online:
-                        if self.replica_mode == replica_mode_t.Auto:
-                            s=vpn_status_t.Replica
-                        
-                        # TODO possibly questionable - if we were in Replica state to begin with, it might
-                        # be best if we return to that
-                        else:
-                            s=vpn_status_t.Offline
+                await self._set_status(vname, s)
+                vpn.lock.unlock()
+                return False
 
-                        await self._set_status(vname, s)
-                        return
+        vpn.lock.unlock()
 
 
 
@@ -820,16 +1300,11 @@ class node():
     How exactly the scripts accomplish this remains abstract from the point of view of this program
     """
 
-    async def _cmd(self, *args):
+    # `env` is added to our own environment for the command
+    # see cmd_executor for limits on concurrency and run time
+    async def _cmd(self, *args, env : Optional[Dict[str, str]]=None):
         self._logger.info('_cmd(%s)' % [*args])
-        proc_obj=await asyncio.create_subprocess_exec(
-            *args,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-        )
-
-        stdout, stderr = await proc_obj.communicate()
-        return (proc_obj.returncode, stdout, stderr)
+        return await self.executor.run(*args, env=env)
 
 
 
@@ -838,13 +1313,17 @@ class node():
     we also have connectivity)
     """
     async def check_local_vpn_process(self, vname : str) -> bool:
+        return await self.local_checks.do(vname, 'process', functools.partial(self._check_local_vpn_process, vname))
+
+    async def _check_local_vpn_process(self, vname : str) -> bool:
         v=self._local_vpn_obj(vname)
 
         (ret, stdout, stderr)=await self._cmd(
             os.path.join(self._script_path, 'check-pid.sh'),
             str(vname),
             str(v.local_addr),
-            self.local_config["local_vpn_dir"]
+            self.local_config["local_vpn_dir"],
+            env=self.ssh_mux.env(vname)
         )
 
         if ret == 0:
@@ -857,24 +1336,21 @@ class node():
     ssh into the VPN container to verify connectivity
     """
     async def check_local_vpn_connectivity(self, vname : str) -> bool:
+        return await self.local_checks.do(vname, 'connectivity', functools.partial(self._check_local_vpn_connectivity, vname))
+
+    async def _check_local_vpn_connectivity(self, vname : str) -> bool:
         # TODO check it's a local vpn
-        v=self._local_vpn_obj(vname)
+        timeout=self.local_config['local_vpn_check_timeout']
 
         for _ in range(-1, self.local_config['local_vpn_check_retries']):
 
-            (ret, stdout, stderr)=await self._cmd(
-                os.path.join(self._script_path, 'vpn-check-online.sh'),
-                str(v.local_addr),
-                str(self.local_config['local_vpn_check_timeout']),
+            result=await self.vpn_probe.probe(vname, timeout)
+            self.last_probe[vname]=result
 
-                # for testing purposes
-                str(vname),
-            )
-
-            if ret == 0:
+            if result.ok:
                 return True
 
-        self._logger.info(f'check_local_vpn_connectivity({vname}): detected not online: stdout={stdout} stderr={stderr}')
+        self._logger.info(f'check_local_vpn_connectivity({vname}): detected not online: {result.detail}')
         return False
 
 
@@ -895,8 +1371,10 @@ class node():
             os.path.join(self._script_path, f'vpn-set-offline.sh'),
             vname,
             str(v.local_addr),
-            self.local_config["local_vpn_dir"]
+            self.local_config["local_vpn_dir"],
+            env=self.ssh_mux.env(vname)
         )
+        self.local_checks.forget(vname)
 
         if remove_route:
             (ret, stdout, stderr)=await self._cmd(
@@ -921,8 +1399,10 @@ class node():
             str(v.local_addr),
             self.local_config["local_vpn_dir"],
             self.site_id,
-            str(self.sites[self.site_id].gateway_addr)
+            str(self.sites[self.site_id].gateway_addr),
+            env=self.ssh_mux.env(vname)
         )
+        self.local_checks.forget(vname)
 
         if ret != 0:
             stderr_enc=stderr.decode('utf-8')
@@ -0,0 +1,97 @@
+import asyncio
+import logging
+import os
+import time
+
+from dataclasses import dataclass
+
+"""
+connectivity probes for local VPN containers, used by node.check_local_vpn_connectivity
+
+the backend is chosen by the `local_vpn_check_backend` setting:
+
+    script: run vpn-check-online.sh, which pings through the VPN from within the container over
+            SSH. this is the default
+    tcp:    open a TCP connection to `local_vpn_check_port` on the container's local address,
+            from our own event loop. something in the container has to accept connections on
+            that port only while the VPN is up, for example a port forwarded through the tunnel
+            or a small agent. this avoids a process (and an SSH connection) per probe, and any
+            number of containers can be probed at the same time
+"""
+
+@dataclass
+class probe_result():
+    ok : bool
+    # seconds taken by the probe
+    latency : float
+    # output or error, for logging
+    detail : str=''
+
+
+class probe_backend():
+
+    def __init__(self, node, logger : logging.Logger):
+        self.node=node
+        self._logger=logger
+
+    async def probe(self, vname : str, timeout : float) -> probe_result:
+        raise NotImplementedError
+
+
+class script_probe(probe_backend):
+
+    async def probe(self, vname : str, timeout : float) -> probe_result:
+        v=self.node._local_vpn_obj(vname)
+
+        start=time.monotonic()
+        (ret, stdout, stderr)=await self.node._cmd(
+            os.path.join(self.node._script_path, 'vpn-check-online.sh'),
+            str(v.local_addr),
+            str(timeout),
+
+            # for testing purposes
+            str(vname),
+            env=self.node.ssh_mux.env(vname)
+        )
+
+        return probe_result(ret == 0, time.monotonic() - start, f'stdout={stdout} stderr={stderr}')
+
+
+class tcp_probe(probe_backend):
+
+    def __init__(self, node, logger : logging.Logger):
+        super().__init__(node, logger)
+        self._port=int(node.local_config['local_vpn_check_port'])
+
+    async def probe(self, vname : str, timeout : float) -> probe_result:
+        v=self.node._local_vpn_obj(vname)
+
+        start=time.monotonic()
+        try:
+            (_, writer)=await asyncio.wait_for(
+                asyncio.open_connection(str(v.local_addr), self._port),
+                timeout
+            )
+        except (OSError, asyncio.TimeoutError) as e:
+            return probe_result(False, time.monotonic() - start, f'{type(e).__name__}: {e}')
+
+        latency=time.monotonic() - start
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+
+        return probe_result(True, latency)
+
+
+def make_probe(node, logger : logging.Logger) -> probe_backend:
+    match node.local_config['local_vpn_check_backend']:
+        case 'script':
+            return script_probe(node, logger)
+        case 'tcp':
+            return tcp_probe(node, logger)
+        case s:
+            raise Exception(
+                f'local_vpn_check_backend config setting must be one of script or tcp, but was {s}'
+            )
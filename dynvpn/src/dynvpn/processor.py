@@ -3,7 +3,8 @@
 import asyncio
 import logging
 import traceback
-from collections import deque
+import time
+from collections import deque, OrderedDict
 
 
 from dynvpn.common import vpn_status_t, site_status_t, vpn_t, site_t, str_to_vpn_status_t, \
@@ -15,9 +16,26 @@ to temporarily pause processing and queue incoming events until processing is re
 
 this "processor" class does this, passing de-queued items to the given handler
 currently this is used for handle_peer_vpn_status, where we disable processing at startup
+
+items are queued by key (see `key`), and keys are processed in the order in which they were first 
+queued. items with the same key are always processed in the order they were added. if `coalesce`
+is True, a key has at most one pending item: a newer item replaces the pending one, keeping its
+place in the queue
+
+each item is also assigned a lane (see `lane`), and `lanes` lists the lanes in order of priority:
+items in a lane are only processed when there are none waiting in the lanes before it. when an item
+is added for a key which is waiting in a lower-priority lane, the key moves to the new item's lane, 
+so that items with the same key stay in order
+
+if `concurrency` is greater than 1, up to that many items are handled at the same time, each in 
+its own task, but never two items with the same key
 """
 class processor():
 
+    coalesce=False
+    concurrency=1
+    lanes=[ 'default' ]
+
     # singleton, where we ignore args/kwargs (which are eventually passed to __init__)
     def __new__(cls, *args, **kwargs):
         if not hasattr(cls, "instance"):
@@ -26,24 +44,99 @@ class processor():
 
     def __init__(self, node):
         self.pending_items=asyncio.Event()
-        # argument lists
-        self.items=deque()
+        # set while active with no items queued or being handled, see node._do_start
+        self.idle=asyncio.Event()
+        # lane -> key -> deque of (argument lists, time queued)
+        self.items={ lane: OrderedDict() for lane in self.lanes }
+        # key -> lane the key is currently waiting in
+        self._key_lane={}
         self.active=False
         self.discard=False
         self.logger=node._logger
         self.node=node
 
+        # keys of items currently being handled, when concurrency > 1
+        self._inflight=set()
+        # used to give each handler task a unique name
+        self._seq=0
+
+        # lane -> counters for items taken from the lane, see stats
+        self._lane_stats={
+            lane: { 'dequeued': 0, 'wait_total': 0.0, 'wait_max': 0.0 } for lane in self.lanes
+        }
+        # lane -> number of items waiting
+        self._depth={ lane: 0 for lane in self.lanes }
+
     async def handler(self):
         raise NotImplementedError
 
+    """
+    the key an item is queued under, given the arguments to `add`
+    by default each item has its own key, so items are simply processed in order
+    """
+    def key(self, *args, **kwargs):
+        return object()
+
+    """
+    the lane an item is queued in, given the arguments to `add`; one of `lanes`
+    """
+    def lane(self, *args, **kwargs) -> str:
+        return self.lanes[0]
+
+    """
+    per lane: number of items waiting, and how long items taken from the lane had waited (seconds)
+    """
+    def stats(self):
+        ret={}
+        for lane in self.lanes:
+            st=self._lane_stats[lane]
+            ret[lane]={
+                'depth': self._depth[lane],
+                'dequeued': st['dequeued'],
+                'wait_avg': st['wait_total'] / st['dequeued'] if st['dequeued'] > 0 else 0.0,
+                'wait_max': st['wait_max'],
+            }
+        return ret
+
+    """
+    remove and return the next item, as (key, args, kwargs), from the highest-priority lane which 
+    has one, skipping keys in `exclude`; None if there is no such item
+    """
+    def _pop(self, exclude=()):
+        for lane in self.lanes:
+            keys=self.items[lane]
+            for key, q in keys.items():
+                if key in exclude:
+                    continue
+
+                (args, kwargs, queued)=q.popleft()
+                if len(q) == 0:
+                    del keys[key]
+                    del self._key_lane[key]
+                else:
+                    # let other keys go before this key's next item
+                    keys.move_to_end(key)
+
+                wait=time.monotonic() - queued
+                st=self._lane_stats[lane]
+                st['dequeued'] += 1
+                st['wait_total'] += wait
+                st['wait_max']=max(st['wait_max'], wait)
+                self._depth[lane] -= 1
+
+                return (key, args, kwargs)
+
+        return None
+
     async def start(self):
-        while True:
-            while len(self.items) > 0:
-                if not self.active:
-                    break
+        if self.concurrency > 1:
+            await self._start_concurrent()
+            return
 
+        while True:
+            while self.active and (item := self._pop()) is not None:
                 try:
-                    (args, kwargs)=self.items.pop()
+                    (_, args, kwargs)=item
                     await self.handler(*args, **kwargs)
                 except Exception as e:
                     self.logger.warning(f'processor caught exception: {e}')
@@ -51,12 +144,76 @@ class processor():
 
             
             self.pending_items.clear()
+            if self.active:
+                self.idle.set()
             await self.pending_items.wait()
         
+    async def _start_concurrent(self):
+        while True:
+            # cleared before dispatching, so that a handler finishing during dispatch isn't missed
+            self.pending_items.clear()
+            self._dispatch()
+            if self.active and len(self._key_lane) == 0 and len(self._inflight) == 0:
+                self.idle.set()
+            await self.pending_items.wait()
+
+    """
+    start handler tasks for queued items whose key is not already being handled, up to 
+    `concurrency` in total
+    """
+    def _dispatch(self):
+        if not self.active:
+            return
+
+        while len(self._inflight) < self.concurrency:
+            if (item := self._pop(self._inflight)) is None:
+                return
+
+            (key, args, kwargs)=item
+            self._inflight.add(key)
+            self._seq += 1
+            self.node.task_manager.add(
+                self._run_handler(key, args, kwargs),
+                f'{type(self).__name__}.handler({self._seq})'
+            )
+
+    async def _run_handler(self, key, args, kwargs):
+        try:
+            await self.handler(*args, **kwargs)
+        except Exception as e:
+            self.logger.warning(f'processor caught exception: {e}')
+            print(traceback.format_exc())
+        finally:
+            self._inflight.discard(key)
+            self.pending_items.set()
+
     def add(self, *args, **kwargs):
         if self.discard is False:
-            self.items.append( (args, kwargs) )
-
+            key=self.key(*args, **kwargs)
+            lane=self.lane(*args, **kwargs)
+
+            if (current_lane := self._key_lane.get(key)) is None:
+                self.items[lane][key]=deque()
+                self._key_lane[key]=lane
+            elif self.lanes.index(lane) < self.lanes.index(current_lane):
+                # move the key's pending items up to the new item's lane
+                q=self.items[current_lane].pop(key)
+                self._depth[current_lane] -= len(q)
+                self._depth[lane] += len(q)
+                self.items[lane][key]=q
+                self._key_lane[key]=lane
+            else:
+                lane=current_lane
+
+            q=self.items[lane][key]
+            if self.coalesce and len(q) > 0:
+                # keep the time the replaced item was queued
+                q[0]=(args, kwargs, q[0][2])
+            else:
+                q.append( (args, kwargs, time.monotonic()) )
+                self._depth[lane] += 1
+
+            self.idle.clear()
             if self.active:
                 self.pending_items.set()
 
@@ -66,20 +223,42 @@ class processor():
     def activate(self):
         self.active=True
         self.logger.debug('processor %s activated' % type(self))
-        if len(self.items) > 0:
-            self.pending_items.set()
+        # wake the loop even if nothing is queued, so that it sets `idle`
+        self.pending_items.set()
     
     def deactivate(self):
         self.active=False
+        self.idle.clear()
+
 
+# peer VPN statuses which can lead to failover are handled before other updates
+# see peer_vpn_status_second.handler
+_failover_statuses=[ vpn_status_t.Failed, vpn_status_t.Offline ]
 
 class peer_vpn_status_first(processor):
+
+    # only the latest status received for a VPN matters; the handler compares it with the 
+    # status we have recorded
+    coalesce=True
+    lanes=[ 'failover', 'default' ]
+
+    def key(self, site_id : str, vname : str, status : vpn_status_t):
+        return (site_id, vname)
+
+    def lane(self, site_id : str, vname : str, status : vpn_status_t):
+        return 'failover' if status in _failover_statuses else 'default'
+
     """
     handle items that were received by handle_peer_state
     """
     async def handler(self, site_id : str, vname : str, status : vpn_status_t):
 
 
+        # the site may have been removed by a configuration reload since the update was queued
+        if site_id not in self.node.sites:
+            self.logger.warning(f'peer_vpn_status_first: site {site_id} not configured')
+            return
+
         if vname not in self.node.sites[site_id].vpn:
             self.logger.warning(f'peer_vpn_status_first: vpn {vname} not configured for site {site_id}')
             return
@@ -87,7 +266,7 @@ class peer_vpn_status_first(processor):
         remote_vpn=self.node.sites[site_id].vpn[vname]
         previous_status=remote_vpn.status
 
-        remote_vpn.status=status
+        remote_vpn.set_status(status)
 
         #self.logger.debug(f'peer_vpn_status_first({vname}@{site_id}): {status}')
 
@@ -102,45 +281,70 @@ class peer_vpn_status_first(processor):
 
 
 class peer_vpn_status_second(processor):
+
+    # each item is a transition, which can't be merged with another without possibly losing one
+    # that requires action (for example Online -> Failed followed by Failed -> Replica), so items 
+    # are not coalesced, but are still kept in order for each VPN
+    lanes=[ 'failover', 'default' ]
+
+    # keyed by VPN only: transitions of the same VPN at different peers can each lead us to bring 
+    # the local VPN online or offline, so they are handled one at a time
+    def key(self, site_id : str, vname : str, status : vpn_status_t, previous_status : vpn_status_t):
+        return vname
+
+    # transitions to Replica or Pending are ignored by the handler, while Online can cause us to 
+    # go to Replica; these wait behind any transitions which can cause failover
+    def lane(self, site_id : str, vname : str, status : vpn_status_t, previous_status : vpn_status_t):
+        return 'failover' if status in _failover_statuses else 'default'
+
+    def __init__(self, node):
+        super().__init__(node)
+
+        # handling an item can mean bringing a VPN online, which takes a while; VPNs are handled 
+        # concurrently so that one VPN's failover doesn't wait for another's
+        self.concurrency=node.local_config['max_concurrent_failovers']
+
     async def handler(self, site_id : str, vname : str, status : vpn_status_t, previous_status : vpn_status_t):
         vs=vpn_status_t
-        if vname in self.node.replica_priority:
-            rp=self.node.replica_priority[vname]
-        else:
-            rp=None
+        rp=self.node.replica_rings.get(vname)
 
         # if a VPN is unavailable, check the replica list to see if we need to take any
         # action (failover)
         match (previous_status, status):
-            case (vs.Online, vs.Failed) | (vs.Pending, vs.Failed) | (_, vs.Offline):
+            # only a copy which was serving (or about to) needs replacing; a Replica or Offline copy 
+            # going Offline doesn't
+            case (vs.Online | vs.Pending, vs.Failed) | (vs.Online | vs.Pending | vs.Failed, vs.Offline):
 
                 if rp is None:
                     self.logger.info(f'peer_vpn_status_second({vname}@{site_id}): peer status Offline: VPN not present in replica_priority, discarding this update')
                     return
 
-                # come online if the offline self.node is directly above us, including when the the self.node is last
-                # in the list and we are first
+                if (serving_at := self.node._serving_elsewhere(vname, site_id)) is not None:
+                    self.logger.info(f'peer_vpn_status_second({vname}@{site_id}): peer status Offline: Online or Pending at {serving_at}, no failover needed')
+                    return
+
+                # come online if we are the first live replica after the offline site in the list, 
+                # including when the offline site is last in the list and we come before it
                 if self.node.site_id in rp:
 
                     # TODO overall design for replica distance and replica priority to be updated based on 
                     # observed behavior
 
-                    # among other things, _replica_distance will check that we are in Replica state
-                    rd=self.node._replica_distance(site_id, self.node.site_id, vname)
-                    self.logger.info(f'peer_vpn_status_second({vname}@{site_id}): peer status Offline: rd={rd}')
+                    # only sites with the VPN in Replica state are considered, so this will be None
+                    # if we are not in Replica state
+                    successor=self.node._failover_successor(site_id, vname)
+                    self.logger.info(f'peer_vpn_status_second({vname}@{site_id}): peer status Offline: successor={successor}')
 
-                    (d, rp)=rd
-                        
-                    #condition=\
-                    #    d == 1 or \
-                    #    (self.node.replica_priority[vname][0] == self.node.site_id and self.node.replica_priority[vname][-1] == site_id)
+                    if successor == self.node.site_id and \
+                        self.node._local_vpn_obj(vname).status == vpn_status_t.Replica:
 
-                    if self.node._local_vpn_obj(vname).status == vpn_status_t.Replica:
-                        if d == 1 or len(rp) == 0:
-                            await self.node.vpn_online(vname)
-                            return
+                        await self.node.vpn_online(vname)
+                        return
                 else:
-                    self.logger.info(f'peer_vpn_status_second({vname}@{site_id}): peer status Offline: local site not configured as Replica (skipping) (rp={rp})')
+                    self.logger.info(f'peer_vpn_status_second({vname}@{site_id}): peer status Offline: local site not configured as Replica (skipping) (rp={rp.order})')
+
+            case (_, vs.Offline):
+                pass
 
             case (_, vs.Online):
 
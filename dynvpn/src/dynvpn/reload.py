@@ -0,0 +1,349 @@
+import asyncio
+import datetime
+import logging
+import os
+
+import yaml
+
+from typing import Optional, Dict, List, Tuple
+
+from dynvpn.common import vpn_t, site_t, str_to_replica_mode_t
+from dynvpn.config import load_config
+
+"""
+reloads local.yml and global.yml while running, applying only what changed
+
+a reload is requested with POST /reload_config, or happens on its own when either file is
+modified, if `config_watch_interval` is set. the new configuration is compared with the one in
+use, and:
+
+    - peers added to `sites` are loaded and pulled from, and peers removed from it are forgotten
+    - a peer whose address or VPN address base changed is forgotten and loaded again
+    - VPNs added to or removed from a peer's `vpn` list are added to or removed from our view
+    - VPNs added to the local site's `vpn` list are started as they would be at startup (Online
+      if we are first in their replica_priority and no peer has them Online, otherwise Replica
+      or Offline), and VPNs removed from it are set Offline (telling the peers) and forgotten
+    - replica_priority lists which changed are compiled again
+    - replica_mode, pull_* and local_vpn_check_* settings are applied to what's running
+    - other settings which are read each time they are used take effect from then on
+
+settings which are only read at startup (see _restart_keys) keep their current value until the
+instance is restarted; they are listed in the result of the reload. a configuration which can't
+be read, or which changes the local site's ID, is not applied at all
+"""
+
+# settings in local.yml which only take effect on restart
+_restart_keys=[
+    'site_id',
+    'script_path',
+    'ssh_mux',
+    'ssh_mux_dir',
+    'ssh_mux_identity',
+    'ssh_mux_user',
+    'ssh_mux_reconnect_delay',
+    'cmd_concurrency',
+    'cmd_timeout',
+    'cmd_timeouts',
+    'peer_conn_limit',
+    'peer_keepalive_timeout',
+    'broadcast_coalesce_delay',
+    'max_concurrent_failovers',
+    'local_vpn_check_backend',
+    'local_vpn_check_port',
+    'local_vpn_check_batch',
+    'local_check_cache_ttl',
+    'snapshot_path',
+    'snapshot_max_age',
+    'snapshot_delay',
+    'config_watch_interval',
+]
+
+# settings of each entry in `sites` which change how a peer is reached, or what its VPNs'
+#   addresses are
+_site_keys=[ 'peer_addr', 'peer_port', 'gateway_addr', 'vpn_local_addr_base' ]
+
+class config_reloader():
+
+    # config_files: (local.yml, global.yml), or None if the node wasn't loaded from files
+    def __init__(self, node, logger : logging.Logger, config_files : Optional[Tuple[str, str]]):
+        self.node=node
+        self._logger=logger
+        self._files=config_files
+
+        # reloads run one at a time
+        self._lock=asyncio.Lock()
+        # modification times of the files when they were last read, see _watch
+        self._mtimes : Optional[Tuple[float, float]]=None
+
+        self.counters={
+            'reloads': 0,
+            'unchanged': 0,
+            'errors': 0,
+        }
+        # result of the most recent reload
+        self.last : Optional[Dict]=None
+
+    """
+    start watching the files, if config_watch_interval is set
+    called once startup has finished
+    """
+    def start(self):
+        if self._files is None:
+            return
+
+        self._mtimes=self._stat()
+
+        interval=float(self.node.local_config['config_watch_interval'])
+        if interval > 0:
+            self.node.scheduler.schedule('config-watch', self._watch, interval, interval)
+
+    def _stat(self) -> Optional[Tuple[float, float]]:
+        try:
+            return tuple(os.stat(path).st_mtime for path in self._files)
+        except OSError as e:
+            self._logger.warning(f'config_reloader: {e}')
+            return None
+
+    async def _watch(self):
+        if (mtimes := self._stat()) is not None and mtimes != self._mtimes:
+            self._logger.info('config_reloader: configuration files changed, reloading')
+            await self.reload()
+
+    """
+    read the configuration files again and apply the differences
+
+    returns a summary of what was changed, or { 'error': ... } if nothing was applied
+    """
+    async def reload(self) -> Dict:
+        if self._files is None:
+            return { 'error': 'not started from configuration files' }
+        if not self.node.started:
+            return { 'error': 'startup has not finished yet' }
+
+        async with self._lock:
+            mtimes=self._stat()
+            try:
+                (local_config, global_config)=load_config(*self._files)
+                self._validate(local_config, global_config)
+            except (OSError, yaml.YAMLError, KeyError, ValueError) as e:
+                self.counters['errors'] += 1
+                self._logger.error(f'config_reloader: not reloading: {e}')
+                self.last={ 'error': str(e) }
+                return self.last
+            self._mtimes=mtimes
+
+            summary={
+                'changed': [],
+                'restart_required': [],
+            }
+            await self._apply(local_config, global_config, summary)
+
+            if len(summary['changed']) > 0:
+                self.counters['reloads'] += 1
+                self.node.snapshot.request()
+            else:
+                self.counters['unchanged'] += 1
+
+            if len(summary['restart_required']) > 0:
+                self._logger.warning(
+                    'config_reloader: these settings take effect after a restart: '
+                    + ', '.join(summary['restart_required'])
+                )
+            self._logger.info(f'config_reloader: reloaded, {len(summary["changed"])} changes')
+
+            self.last=summary
+            return summary
+
+    """
+    raise ValueError if the new configuration can't be applied to this instance
+    """
+    def _validate(self, local_config : Dict, global_config : Dict):
+        node=self.node
+
+        if local_config['site_id'] != node.site_id:
+            raise ValueError(f'site_id changed from {node.site_id} to {local_config["site_id"]}')
+        if node.site_id not in global_config['sites']:
+            raise ValueError(f'local site {node.site_id} not present in site config')
+
+        try:
+            str_to_replica_mode_t(local_config['replica_mode'])
+        except Exception as e:
+            raise ValueError(str(e))
+
+        if 'replica_priority' not in global_config:
+            raise ValueError('missing required key: replica_priority')
+
+        for (site_id, site_config) in global_config['sites'].items():
+            for key in _site_keys + [ 'vpn' ]:
+                if key not in site_config:
+                    raise ValueError(f'site {site_id}: missing required key: {key}')
+            for vpn_id in site_config['vpn']:
+                if not isinstance(vpn_id, int):
+                    raise ValueError(f'site {site_id}: VPN IDs must be integers, got "{vpn_id}"')
+
+    async def _apply(self, local_config : Dict, global_config : Dict, summary : Dict):
+        node=self.node
+        changed : List[str]=summary['changed']
+
+        old_local=node.local_config
+        old_global=node.global_config
+        old_sites=old_global['sites']
+        new_sites=global_config['sites']
+
+        # local.yml
+
+        for key in sorted(set(old_local.keys()) | set(local_config.keys())):
+            if old_local.get(key) == local_config.get(key):
+                continue
+
+            if key in _restart_keys:
+                summary['restart_required'].append(key)
+                # keep the value which is in effect
+                if key in old_local:
+                    local_config[key]=old_local[key]
+                else:
+                    del local_config[key]
+            else:
+                changed.append(key)
+
+        if global_config.get('vpn_anycast_addr_base') != old_global.get('vpn_anycast_addr_base'):
+            summary['restart_required'].append('vpn_anycast_addr_base')
+            global_config['vpn_anycast_addr_base']=old_global.get('vpn_anycast_addr_base')
+
+        local_site_old={ k: old_sites[node.site_id].get(k) for k in _site_keys }
+        local_site_new={ k: new_sites[node.site_id].get(k) for k in _site_keys }
+        if local_site_old != local_site_new:
+            summary['restart_required'].append(f'sites.{node.site_id}')
+            new_sites[node.site_id].update(local_site_old)
+
+        # sites loaded from here on use the new settings (see site_t.load)
+        node.local_config=local_config
+        node.global_config=global_config
+
+        if 'replica_mode' in changed:
+            node.replica_mode=str_to_replica_mode_t(local_config['replica_mode'])
+
+        # peers
+
+        added_sites=[]
+        removed_sites=[]
+        for site_id in old_sites:
+            if site_id == node.site_id or site_id in new_sites:
+                continue
+            self._logger.info(f'config_reloader: removing site {site_id}')
+            await node._remove_site(site_id)
+            removed_sites.append(site_id)
+
+        for (site_id, site_config) in new_sites.items():
+            if site_id == node.site_id:
+                continue
+
+            if site_id in old_sites:
+                old_config=old_sites[site_id]
+                if all(old_config.get(k) == site_config.get(k) for k in _site_keys):
+                    self._apply_peer_vpns(site_id, old_config, site_config, changed)
+                    continue
+
+                self._logger.info(f'config_reloader: site {site_id} changed, loading it again')
+                await node._remove_site(site_id)
+            else:
+                self._logger.info(f'config_reloader: adding site {site_id}')
+
+            node._add_site(site_t.load(node, site_id, site_config, global_config))
+            added_sites.append(site_id)
+
+        changed.extend(f'sites.{site_id}' for site_id in removed_sites + added_sites)
+
+        for (site_id, site) in node.sites.items():
+            if site_id != node.site_id:
+                site.pull_interval=datetime.timedelta(seconds=local_config['pull_interval'])
+                site.pull_timeout=datetime.timedelta(seconds=local_config['pull_timeout'])
+                site.pull_retries=local_config['pull_retries']
+
+        # the phases of the pulls depend on the number of peers, see node._schedule_pulls
+        if len(added_sites) > 0 or len(removed_sites) > 0 or \
+            any(key in changed for key in [ 'pull_interval', 'pull_spread', 'pull_jitter' ]):
+
+            node._schedule_pulls()
+
+        for site_id in added_sites:
+            node.task_manager.add(node.pull_state(site_id), f'reload-pull_{site_id}')
+
+        # local VPNs which were removed
+
+        old_local_vpns=self._vnames(old_sites[node.site_id])
+        new_local_vpns=self._vnames(new_sites[node.site_id])
+
+        for vname in old_local_vpns - new_local_vpns:
+            self._logger.info(f'config_reloader: removing local VPN {vname}')
+            await node._retire_local_vpn(vname)
+            changed.append(f'sites.{node.site_id}.vpn.{vname}')
+
+        # replica_priority
+
+        old_rp=old_global['replica_priority']
+        new_rp=global_config['replica_priority']
+        node.replica_priority=new_rp
+
+        for vname in set(old_rp.keys()) | set(new_rp.keys()):
+            if vname not in new_rp:
+                del node.replica_rings[vname]
+            elif vname not in old_rp or old_rp[vname] != new_rp[vname]:
+                node._build_replica_ring(vname)
+            else:
+                continue
+            changed.append(f'replica_priority.{vname}')
+
+        # local VPNs which were added, once our view of the peers is up to date
+
+        for vname in sorted(new_local_vpns - old_local_vpns):
+            self._logger.info(f'config_reloader: adding local VPN {vname}')
+            site_config=new_sites[node.site_id]
+            vpn_id=next(i for i in site_config['vpn'] if vpn_t.vname(i) == vname)
+
+            node._add_vpn(node.site_id, vpn_t.load(node, node.site_id, vpn_id, site_config, global_config))
+            node.ssh_mux.add(vname)
+            await node._start_local_vpn(vname)
+            changed.append(f'sites.{node.site_id}.vpn.{vname}')
+
+        # VPN checks which are running are started again with the new settings
+
+        if any(key in changed for key in [ 'local_vpn_check_interval', 'local_vpn_check_spread', 'local_vpn_check_jitter' ]):
+            for vname in node.sites[node.site_id].vpn.keys():
+                if f'check-vpn_{vname}' in node.scheduler:
+                    node.scheduler.cancel(f'check-vpn_{vname}')
+                    await node.start_check_vpn_task(vname)
+
+    """
+    add and remove a peer's VPNs to match its new `vpn` list
+    """
+    def _apply_peer_vpns(self, site_id : str, old_config : Dict, site_config : Dict, changed : List[str]):
+        node=self.node
+
+        old_vpns=self._vnames(old_config)
+        new_vpns=self._vnames(site_config)
+
+        for vname in old_vpns - new_vpns:
+            node._remove_vpn(site_id, vname)
+            changed.append(f'sites.{site_id}.vpn.{vname}')
+
+        for vpn_id in site_config['vpn']:
+            vpn=vpn_t.load(node, site_id, vpn_id, site_config, node.global_config)
+            if vpn.name not in old_vpns:
+                node._add_vpn(site_id, vpn)
+                changed.append(f'sites.{site_id}.vpn.{vpn.name}')
+
+        # the peer's next state will include the VPNs we didn't know about
+        if len(new_vpns - old_vpns) > 0:
+            node.http_client.forget_peer(site_id)
+            node.peer_seq.pop(site_id, None)
+
+    def _vnames(self, site_config : Dict):
+        return { vpn_t.vname(vpn_id) for vpn_id in site_config['vpn'] }
+
+    def stats(self):
+        return {
+            **self.counters,
+            'watching': 'config-watch' in self.node.scheduler,
+            'last': self.last,
+        }
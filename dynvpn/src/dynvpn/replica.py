@@ -0,0 +1,87 @@
+from typing import Optional, Dict, List
+
+"""
+a VPN's replica_priority list, compiled into a ring
+
+each site is followed by the next site in the list, and the last site is followed by the first.
+the ring also tracks which sites are currently "live" replicas (see node._replica_live), and for
+each site, the first live replica which follows it. this is the site which should attempt to bring
+the VPN online when that site's copy of the VPN fails (see README.md)
+"""
+class replica_ring():
+
+    def __init__(self, vname : str, order : List[str]):
+        self.vname=vname
+        self.order=list(order)
+
+        # site_id -> index in order
+        self.pos : Dict[str, int]={}
+        for i, site_id in enumerate(self.order):
+            if site_id not in self.pos:
+                self.pos[site_id]=i
+
+        # site_id -> next site in the ring
+        n=len(self.order)
+        self.succ : Dict[str, str]={
+            site_id: self.order[(i+1) % n] for (site_id, i) in self.pos.items()
+        }
+
+        self._live=set()
+        # site_id -> first live site following it, if any (other than the site itself)
+        self._live_succ : Dict[str, Optional[str]]={ site_id: None for site_id in self.pos }
+
+    def __contains__(self, site_id : str) -> bool:
+        return site_id in self.pos
+
+    def __len__(self) -> int:
+        return len(self.order)
+
+    """
+    number of positions which separate sites s1 and s2 in the list
+    positive if s1 has higher replica priority than s2, otherwise negative
+        except: if s1 is last in the list and s2 is first, return 1 (as if s2 follows directly after s1)
+
+    None if either site is not in the list
+    """
+    def distance(self, s1 : str, s2 : str) -> Optional[int]:
+        if s1 not in self.pos or s2 not in self.pos:
+            return None
+
+        p1=self.pos[s1]
+        p2=self.pos[s2]
+
+        if p1 == len(self.order) - 1 and p2 == 0:
+            return 1
+        else:
+            return p2 - p1
+
+    """
+    record whether a site is currently a live replica
+    """
+    def set_live(self, site_id : str, live : bool):
+        if site_id not in self.pos or (site_id in self._live) == live:
+            return
+
+        if live:
+            self._live.add(site_id)
+        else:
+            self._live.discard(site_id)
+
+        self._update_live_succ()
+
+    """
+    first live replica following `site_id` in the ring, not counting `site_id` itself
+    """
+    def live_successor(self, site_id : str) -> Optional[str]:
+        return self._live_succ.get(site_id)
+
+    # walk the ring backwards twice, carrying the nearest live site seen so far
+    def _update_live_succ(self):
+        n=len(self.order)
+        nearest=None
+        for i in reversed(range(2*n)):
+            site_id=self.order[i % n]
+            if i < n and self.pos[site_id] == i:
+                self._live_succ[site_id]=nearest if nearest != site_id else None
+            if site_id in self._live:
+                nearest=site_id
@@ -0,0 +1,276 @@
+import asyncio
+import heapq
+import logging
+import math
+import random
+import time
+
+from collections import deque
+from dataclasses import dataclass
+from typing import Optional, Dict, List, Tuple, Callable, Awaitable
+
+from dynvpn.common import task_kind_t
+
+@dataclass
+class _entry():
+    key : str
+    fn : Callable[[], Awaitable[Optional[bool]]]
+    # repeat every `interval` seconds after each run finishes; None to run once
+    interval : Optional[float]
+    # each due time is randomly moved by up to this many seconds, in either direction
+    jitter : float
+    # if not None, due only at this fraction (0 to 1) of the way through each multiple of 
+    #   `interval` (on the time.monotonic() clock): entries with the same interval and phase run 
+    #   together, and entries with different phases are kept apart
+    phase : Optional[float]
+    vname : Optional[str]
+    kind : Optional[task_kind_t]
+
+    # time.monotonic() when the entry is next due, None while it is running
+    due : Optional[float]=None
+    # the due time before jitter was applied
+    nominal : Optional[float]=None
+    # incremented whenever the entry is (re)scheduled, so that stale heap items can be skipped
+    gen : int=0
+    # task of the current run, if any
+    task : Optional[asyncio.Task]=None
+    runs : int=0
+
+
+"""
+runs all periodic and delayed work of the node (pulls from peers, VPN checks, failure timeouts)
+from a single timer, instead of a task sleeping in a loop for each
+
+work is scheduled under a unique key, which is also the name of the task that the task_manager
+runs it in. a periodic entry is due again `interval` seconds after each run finishes (so runs of
+an entry never overlap), until it's cancelled or its function returns False
+
+entries are kept in a heap ordered by due time. cancelling or rescheduling an entry leaves its
+old heap item in place, which is skipped when it comes up
+"""
+class scheduler():
+
+    def __init__(self, node, logger : logging.Logger):
+        self.node=node
+        self._logger=logger
+
+        # key -> entry
+        self._entries : Dict[str, _entry]={}
+        # (due, seq, key, gen)
+        self._heap : List[Tuple[float, int, str, int]]=[]
+        self._seq=0
+
+        # set when the earliest due time may have changed
+        self._wakeup=asyncio.Event()
+
+        self.counters={
+            'scheduled': 0,
+            'fired': 0,
+            'cancelled': 0,
+            # how long after their due time entries have been fired (seconds)
+            'late_max': 0.0,
+        }
+
+        # times at which entries were recently fired, see spread
+        self._fired_at : deque=deque(maxlen=4096)
+
+    def __contains__(self, key : str) -> bool:
+        return key in self._entries
+
+    """
+    run `fn` after `delay` seconds, and then every `interval` seconds if given
+    replaces any existing entry with the same key
+    if `phase` is given (with `interval`), each run is instead at the first point at that phase 
+        of the interval (see _entry) after `delay` seconds have passed
+    if `vname` and `kind` are given, the task of each run can be found with task_manager.find_vpn
+    """
+    def schedule(self, key : str, fn : Callable[[], Awaitable[Optional[bool]]], delay : float,
+        interval : Optional[float]=None, jitter : float=0.0, phase : Optional[float]=None,
+        vname : Optional[str]=None, kind : Optional[task_kind_t]=None):
+
+        self.cancel(key)
+
+        if interval is None:
+            phase=None
+        e=self._entries[key]=_entry(key, fn, interval, jitter, phase, vname, kind)
+        self._push(e, delay)
+        self.counters['scheduled'] += 1
+
+    """
+    change when an entry is next due; returns False if there is no such entry or it is running
+    """
+    def reschedule(self, key : str, delay : float) -> bool:
+        if (e := self._entries.get(key)) is None or e.due is None:
+            return False
+
+        self._push(e, delay)
+        return True
+
+    """
+    remove an entry, cancelling its current run unless that's the calling task
+    returns False if there was no such entry
+    """
+    def cancel(self, key : str) -> bool:
+        if (e := self._entries.pop(key, None)) is None:
+            return False
+
+        if e.task is not None and e.task is not asyncio.current_task():
+            e.task.cancel()
+        self.counters['cancelled'] += 1
+        return True
+
+    # if `after` is given, the entry is due at the earliest one interval after that time (see
+    #   _run_entry)
+    def _push(self, e : _entry, delay : float, after : Optional[float]=None):
+        now=time.monotonic()
+        start=now + delay
+        if after is not None:
+            # half an interval, so that the phase point at `after` itself isn't picked again
+            start=max(start, after + e.interval / 2)
+
+        if e.phase is not None:
+            offset=e.phase * e.interval
+            e.nominal=(math.floor((start - offset) / e.interval) + 1) * e.interval + offset
+        else:
+            e.nominal=start
+
+        e.due=e.nominal
+        if e.jitter > 0:
+            e.due=max(now, e.due + random.uniform(-e.jitter, e.jitter))
+
+        e.gen += 1
+        self._seq += 1
+        heapq.heappush(self._heap, (e.due, self._seq, e.key, e.gen))
+
+        # drop stale items once they make up most of the heap
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            self._heap=[ item for item in self._heap if self._current(item) is not None ]
+            heapq.heapify(self._heap)
+
+        self._wakeup.set()
+
+    # the entry a heap item refers to, or None if the item is stale
+    def _current(self, item) -> Optional[_entry]:
+        (_, _, key, gen)=item
+        if (e := self._entries.get(key)) is not None and e.gen == gen and e.due is not None:
+            return e
+        return None
+
+    async def run(self):
+        while True:
+            now=time.monotonic()
+
+            while len(self._heap) > 0 and self._heap[0][0] <= now:
+                item=heapq.heappop(self._heap)
+                if (e := self._current(item)) is not None:
+                    self._fire(e, now)
+
+            self._wakeup.clear()
+            timeout=self._heap[0][0] - now if len(self._heap) > 0 else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except TimeoutError:
+                pass
+
+    def _fire(self, e : _entry, now : float):
+        self.counters['fired'] += 1
+        self.counters['late_max']=max(self.counters['late_max'], now - e.due)
+
+        e.due=None
+        e.runs += 1
+        self._fired_at.append(now)
+        self.node.task_manager.add(self._run_entry(e), e.key, e.vname, e.kind)
+        e.task=self.node.task_manager.find(e.key)
+
+    async def _run_entry(self, e : _entry):
+        again=False
+        try:
+            again=(await e.fn()) is not False and e.interval is not None
+        finally:
+            e.task=None
+
+            # the entry may have been cancelled or replaced while running
+            if self._entries.get(e.key) is e:
+                if again:
+                    # with jitter, a run can start and finish before its nominal due time, and
+                    #   the next run mustn't be at that same time
+                    self._push(e, 0 if e.phase is not None else e.interval, after=e.nominal)
+                else:
+                    del self._entries[e.key]
+
+    """
+    entries in the order they are due, with the number of seconds until each is due
+    (None for entries which are running)
+    """
+    def upcoming(self, limit : Optional[int]=None) -> List[Dict]:
+        now=time.monotonic()
+        entries=sorted(self._entries.values(), key=lambda e: (e.due is not None, e.due or 0))
+
+        return [
+            {
+                'key': e.key,
+                'due_in': e.due - now if e.due is not None else None,
+                'interval': e.interval,
+                'runs': e.runs,
+            }
+            for e in entries[:limit]
+        ]
+
+    """
+    how evenly work is spread over time
+
+    for each interval shared by periodic entries, a histogram of where in the interval those 
+    entries are next due (in up to 10 equal parts, but no more parts than entries), and 
+    `peak_to_mean`, the largest count in the histogram divided by the average; 1.0 is perfectly 
+    even, while the number of parts means all entries are due together
+
+    `fired`: the number of entries fired in each second of the last `window` seconds, with the same
+    ratio for the busiest second
+    """
+    def spread(self, window : int=60):
+        ret={}
+        now=time.monotonic()
+
+        by_interval : Dict[float, List[_entry]]={}
+        for e in self._entries.values():
+            if e.interval is not None and e.due is not None:
+                by_interval.setdefault(e.interval, []).append(e)
+
+        phases={}
+        for interval, entries in by_interval.items():
+            nbuckets=min(10, len(entries))
+            hist=[0] * nbuckets
+            for e in entries:
+                hist[min(nbuckets - 1, int((e.due % interval) / interval * nbuckets))] += 1
+            phases[interval]={
+                'entries': len(entries),
+                'histogram': hist,
+                'peak_to_mean': max(hist) / (len(entries) / nbuckets),
+            }
+        ret['phases']=phases
+
+        # only count the seconds since the first entry we know of was fired
+        if len(self._fired_at) > 0:
+            window=max(1, min(window, math.ceil(now - self._fired_at[0])))
+
+        per_second=[0] * window
+        for t in self._fired_at:
+            if (age := int(now - t)) < window:
+                per_second[age] += 1
+        total=sum(per_second)
+        ret['fired']={
+            'window': window,
+            'total': total,
+            'max_per_second': max(per_second),
+            'peak_to_mean': max(per_second) / (total / window) if total > 0 else 0.0,
+        }
+
+        return ret
+
+    def stats(self):
+        return {
+            **self.counters,
+            'entries': len(self._entries),
+            'running': len([ e for e in self._entries.values() if e.due is None ]),
+            'heap': len(self._heap),
+        }
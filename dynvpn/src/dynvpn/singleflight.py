@@ -0,0 +1,91 @@
+import asyncio
+import logging
+import time
+
+from typing import Optional, Dict, Tuple, Callable, Awaitable, Any
+
+"""
+shares the results of local VPN checks between concurrent callers
+
+the same container can be checked by several tasks at the same moment (a check-vpn entry,
+vpn_online, a restart, startup). with `do`, a check of a given kind for a given VPN runs at most
+once at a time: callers which arrive while it's running wait for it and get the same result.
+
+if `ttl` is greater than 0, a result is also returned to callers for that many seconds after the
+check finished, without running the check again
+
+the check runs in its own task, so that a caller being cancelled doesn't cancel it for the
+others. `forget` should be called when something is done to a VPN's container which would change
+the result of its checks, so that later callers don't get an outdated result
+"""
+class single_flight():
+
+    def __init__(self, node, logger : logging.Logger, ttl : float=0.0):
+        self.node=node
+        self._logger=logger
+        self._ttl=ttl
+
+        # (vname, kind) -> task running the check
+        self._inflight : Dict[Tuple[str, str], asyncio.Task]={}
+        # (vname, kind) -> (time.monotonic() when the check finished, result)
+        self._cache : Dict[Tuple[str, str], Tuple[float, Any]]={}
+        # used to give each check task a unique name
+        self._seq=0
+
+        self.counters={
+            'calls': 0,
+            'runs': 0,
+            'shared': 0,
+            'cached': 0,
+        }
+
+    async def do(self, vname : str, kind : str, fn : Callable[[], Awaitable[Any]]) -> Any:
+        key=(vname, kind)
+        self.counters['calls'] += 1
+
+        if self._ttl > 0 and (cached := self._cache.get(key)) is not None:
+            (finished, result)=cached
+            if time.monotonic() - finished < self._ttl:
+                self.counters['cached'] += 1
+                return result
+            del self._cache[key]
+
+        if (t := self._inflight.get(key)) is not None:
+            self.counters['shared'] += 1
+        else:
+            self.counters['runs'] += 1
+            self._seq += 1
+            tname=f'{kind}-check_{vname}({self._seq})'
+            self.node.task_manager.add(self._run(key, fn), tname)
+            t=self._inflight[key]=self.node.task_manager.find(tname)
+
+        return await asyncio.shield(t)
+
+    async def _run(self, key : Tuple[str, str], fn : Callable[[], Awaitable[Any]]):
+        try:
+            result=await fn()
+        finally:
+            # the check may have been forgotten (and another started) while running
+            forgotten=self._inflight.get(key) is not asyncio.current_task()
+            if not forgotten:
+                del self._inflight[key]
+
+        if self._ttl > 0 and not forgotten:
+            self._cache[key]=(time.monotonic(), result)
+        return result
+
+    """
+    discard cached results for the VPN, and don't share checks already running with later callers
+    """
+    def forget(self, vname : str):
+        for key in [ key for key in self._cache if key[0] == vname ]:
+            del self._cache[key]
+        for key in [ key for key in self._inflight if key[0] == vname ]:
+            del self._inflight[key]
+
+    def stats(self):
+        return {
+            **self.counters,
+            'inflight': len(self._inflight),
+            'cache_entries': len(self._cache),
+        }
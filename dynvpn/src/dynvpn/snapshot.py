@@ -0,0 +1,168 @@
+import json
+import logging
+import os
+import time
+
+from typing import Optional, Dict
+
+from dynvpn.common import vpn_status_t, str_to_vpn_status_t
+
+"""
+a local file with the state of this instance, used to restart quickly
+
+when enabled (`snapshot_path`), the snapshot is written shortly after any VPN or site status
+changes (`snapshot_delay`, so that a burst of changes is written once) and when the instance
+shuts down. it contains:
+
+    local:  the status of each local VPN
+    peers:  the status of each peer's VPNs as we last knew them, and the (epoch, seq) of the
+            peer's state they correspond to (see node.peer_seq)
+
+on startup, a snapshot which is at most `snapshot_max_age` seconds old is used to:
+
+    - restore our view of the peers, so that our first pull from each peer only needs what
+      changed since (if the peer hasn't restarted in the meantime)
+    - skip the startup checks of local containers (see node._do_start, phase1) whose state we
+      already know: a VPN which was Online is assumed to still be running, and is checked anyway
+      when it's kept online; a VPN in Replica, Offline or Failed had its process stopped
+
+the snapshot is written to a temporary file which then replaces the previous one, so a crash
+while writing doesn't leave a partial snapshot
+"""
+
+_version=1
+
+class state_snapshot():
+
+    def __init__(self, node, logger : logging.Logger):
+        self.node=node
+        self._logger=logger
+
+        cfg=node.local_config
+        self.path : Optional[str]=cfg['snapshot_path']
+        self._max_age=float(cfg['snapshot_max_age'])
+        self._delay=float(cfg['snapshot_delay'])
+
+        self.counters={
+            'requests': 0,
+            'writes': 0,
+            'errors': 0,
+        }
+
+        # the snapshot found at startup, if any; read before any status is set, since that
+        #   requests a new snapshot
+        self.loaded : Optional[Dict]=self._load() if self.path else None
+
+    def _load(self) -> Optional[Dict]:
+        try:
+            with open(self.path, 'r') as f:
+                data=json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            self._logger.warning(f'state_snapshot: could not read {self.path}: {e}')
+            return None
+
+        if data.get('version') != _version or data.get('site_id') != self.node.site_id:
+            self._logger.warning(f'state_snapshot: ignoring {self.path}: not a snapshot of this site')
+            return None
+
+        self._logger.info(f'state_snapshot: loaded {self.path}, {self.age(data):.1f} seconds old')
+        return data
+
+    def age(self, data : Dict) -> float:
+        return time.time() - data['time']
+
+    """
+    whether the snapshot loaded at startup can be used
+    """
+    def recent(self) -> bool:
+        return self.loaded is not None and self.age(self.loaded) <= self._max_age
+
+    """
+    the status of a local VPN in a recent snapshot, if any
+    """
+    def local_status(self, vname : str) -> Optional[vpn_status_t]:
+        if not self.recent() or (s := self.loaded['local'].get(vname)) is None:
+            return None
+        return str_to_vpn_status_t(s)
+
+    """
+    restore our view of the peers from a recent snapshot
+    """
+    def restore_peers(self):
+        if not self.recent():
+            return
+
+        for site_id, peer in self.loaded['peers'].items():
+            if site_id not in self.node.sites or site_id == self.node.site_id:
+                continue
+
+            site=self.node.sites[site_id]
+            restored={}
+            for vname, s in peer['vpn'].items():
+                if vname in site.vpn:
+                    restored[vname]=str_to_vpn_status_t(s)
+                    site.vpn[vname].set_status(restored[vname])
+
+            # the pull from this peer only returns what changed since, so the client's view of the
+            #   peer (see client.changed_vpns) needs to start from the restored statuses as well
+            self.node.http_client.changed_vpns(site_id, restored)
+
+            if peer.get('seq') is not None:
+                self.node.peer_seq[site_id]=tuple(peer['seq'])
+
+        self._logger.info(f'state_snapshot: restored the state of {len(self.loaded["peers"])} peers')
+
+    """
+    write the snapshot soon, see snapshot_delay
+    """
+    def request(self):
+        if not self.path:
+            return
+
+        self.counters['requests'] += 1
+        if 'snapshot-write' not in self.node.scheduler:
+            self.node.scheduler.schedule('snapshot-write', self._write_task, self._delay)
+
+    async def _write_task(self):
+        self.write()
+
+    def write(self):
+        if not self.path:
+            return
+
+        node=self.node
+        data={
+            'version': _version,
+            'site_id': node.site_id,
+            'time': time.time(),
+            'local': {
+                vname: str(vpn.status) for vname, vpn in node.sites[node.site_id].vpn.items()
+            },
+            'peers': {
+                site_id: {
+                    'vpn': { vname: str(vpn.status) for vname, vpn in site.vpn.items() },
+                    'seq': node.peer_seq.get(site_id),
+                }
+                for site_id, site in node.sites.items() if site_id != node.site_id
+            },
+        }
+
+        tmp=f'{self.path}.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp, self.path)
+            self.counters['writes'] += 1
+        except OSError as e:
+            self.counters['errors'] += 1
+            self._logger.error(f'state_snapshot: could not write {self.path}: {e}')
+
+    def stats(self):
+        return {
+            **self.counters,
+            'path': self.path,
+            'loaded_age': self.age(self.loaded) if self.loaded is not None else None,
+            'recent': self.recent(),
+        }
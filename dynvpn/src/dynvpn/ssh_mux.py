@@ -0,0 +1,152 @@
+import asyncio
+import logging
+import os
+import time
+
+from typing import Dict, Optional
+
+"""
+persistent, multiplexed SSH connections to the local VPN containers
+
+our shell scripts reach each VPN container over SSH, and without multiplexing, every check
+and every operation opens a new SSH connection. when enabled (`ssh_mux`), we keep one OpenSSH
+master connection (ControlMaster) open to each local VPN container, and pass its control socket
+to the scripts in the DYNVPN_SSH_CONTROL environment variable so that their ssh invocations run
+over it.
+
+if a master connection isn't up, the variable is not set, and the scripts connect as usual. if
+the connection drops, it is re-established after `ssh_mux_reconnect_delay` seconds
+"""
+class ssh_mux():
+
+    def __init__(self, node, logger : logging.Logger):
+        self.node=node
+        self._logger=logger
+
+        cfg=node.local_config
+        self.enabled=cfg['ssh_mux']
+        self._dir=cfg['ssh_mux_dir']
+        self._identity=os.path.expanduser(cfg['ssh_mux_identity'])
+        self._user=cfg['ssh_mux_user']
+        self._reconnect_delay=float(cfg['ssh_mux_reconnect_delay'])
+
+        # vname -> running master process
+        self._masters : Dict[str, asyncio.subprocess.Process]={}
+
+        # vname -> connection history, see stats
+        self._health : Dict[str, Dict]={}
+
+    def control_path(self, vname : str) -> str:
+        return os.path.join(self._dir, f'{vname}.sock')
+
+    """
+    whether the master connection for this VPN is up
+    """
+    def healthy(self, vname : str) -> bool:
+        proc=self._masters.get(vname)
+        return proc is not None and proc.returncode is None and os.path.exists(self.control_path(vname))
+
+    """
+    environment for scripts which access this VPN's container
+    """
+    def env(self, vname : str) -> Dict[str, str]:
+        if self.enabled and self.healthy(vname):
+            return { 'DYNVPN_SSH_CONTROL': self.control_path(vname) }
+        else:
+            return {}
+
+    """
+    start maintaining a master connection for each local VPN
+    """
+    def start(self):
+        if not self.enabled:
+            return
+
+        os.makedirs(self._dir, mode=0o700, exist_ok=True)
+
+        for vname in self.node.sites[self.node.site_id].vpn.keys():
+            self.add(vname)
+
+    """
+    start maintaining a master connection for a local VPN (also used for VPNs added by a
+    configuration reload)
+    """
+    def add(self, vname : str):
+        if not self.enabled:
+            return
+
+        vpn=self.node.get_local_vpn(vname)
+        self.node.task_manager.add(self._supervise(vname, str(vpn.local_addr)), f'ssh-mux_{vname}')
+
+    """
+    stop the master connection for a local VPN which is being removed
+    """
+    def remove(self, vname : str):
+        if (t := self.node.task_manager.find(f'ssh-mux_{vname}')) is not None:
+            t.cancel()
+        self._health.pop(vname, None)
+
+    async def _supervise(self, vname : str, local_addr : str):
+        health=self._health.setdefault(vname, {
+            'connects': 0,
+            'disconnects': 0,
+            'since': None,
+            'last_error': None,
+        })
+
+        path=self.control_path(vname)
+
+        while True:
+            # a socket left behind by a previous instance would prevent the master from starting
+            if os.path.exists(path) and vname not in self._masters:
+                os.unlink(path)
+
+            proc=await asyncio.create_subprocess_exec(
+                'ssh', '-M', '-N',
+                '-o', f'ControlPath={path}',
+                '-o', 'ControlPersist=no',
+                '-o', 'StrictHostKeyChecking=off',
+                '-o', 'ConnectTimeout=5',
+                '-o', 'ServerAliveInterval=5',
+                '-o', 'ServerAliveCountMax=2',
+                '-i', self._identity,
+                f'{self._user}@{local_addr}',
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            self._masters[vname]=proc
+            health['connects'] += 1
+            health['since']=time.time()
+            self._logger.debug(f'ssh_mux({vname}): master connection started (pid {proc.pid})')
+
+            try:
+                _, stderr=await proc.communicate()
+            finally:
+                del self._masters[vname]
+                if proc.returncode is None:
+                    proc.terminate()
+
+            health['disconnects'] += 1
+            health['since']=time.time()
+            health['last_error']=stderr.decode('utf-8', 'replace').strip()
+            self._logger.warning(
+                f'ssh_mux({vname}): master connection exited ({proc.returncode}): {health["last_error"]}; '
+                + f'reconnecting in {self._reconnect_delay} seconds'
+            )
+
+            await asyncio.sleep(self._reconnect_delay)
+
+    def stats(self):
+        return {
+            vname: { **h, 'healthy': self.healthy(vname) } for vname, h in self._health.items()
+        }
+
+    """
+    stop all master connections
+    """
+    async def close(self):
+        for proc in list(self._masters.values()):
+            if proc.returncode is None:
+                proc.terminate()
+                await proc.wait()
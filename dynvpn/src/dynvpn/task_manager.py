@@ -2,16 +2,22 @@
 import asyncio
 import traceback
 
-from typing import Coroutine,  List, Callable, Awaitable
+from typing import Coroutine,  List, Callable, Awaitable, Optional, Dict, Tuple
 
 from dataclasses import dataclass
 
 import logging
 
+from dynvpn.common import dynvpn_lock, task_kind_t
+
 @dataclass
 class task_wrapper():
     task : asyncio.Task
-    wait_task : asyncio.Task
+    # resolved by the task_manager after the task has been handled (see _handle)
+    wait_task : asyncio.Future
+
+    # (vname, kind) if the task was tagged as acting on a VPN, see find_vpn
+    vpn_tag : Optional[Tuple[str, task_kind_t]] = None
 
     def __hash__(self):
         return self.task.get_name()
@@ -21,10 +27,23 @@ class task_manager():
 
     def __init__(self, node, logger : logging.Logger): 
 
-        # keep the list of task names separately to avoid dict iterator invalidation
-        # they are kept consistent, and we iterate over the list
+        # task name -> task_wrapper
+        # iteration order is the order in which the tasks were added
         self.tasks_dict=dict()
-        self.tasks_list=list()
+
+        # (vname, kind) -> { task name -> task_wrapper }, for tasks added with vname and kind
+        self._by_vpn : Dict[Tuple[str, task_kind_t], Dict[str, task_wrapper]]=dict()
+
+        # tasks which have finished and are waiting to be handled by `run`
+        # fed by each task's done callback
+        self._finished=asyncio.Queue()
+
+        self.counters={
+            'created': 0,
+            'finished': 0,
+            'failed': 0,
+            'cancelled': 0,
+        }
 
         # TODO when tasks are redesigned this reference to the node class will not be necessary
         self.node = node
@@ -33,105 +52,111 @@ class task_manager():
 
 
     """
-    just ensures that all _handle awaitables are awaited
+    handle each task as it finishes, until there are no tasks left
     """
     async def run(self):
-        while len(self.tasks_list) > 0:
-            for tname in self.tasks_list:
-                tobj=self.tasks_dict[tname]
-                try:
-                    await tobj.wait_task
-
-                except Exception as e: 
-                    self._logger.error(traceback.format_exc()) # TODO confirm this syntax
+        while len(self.tasks_dict) > 0 or not self._finished.empty():
+            tobj=await self._finished.get()
+            try:
+                self._handle(tobj)
+            except Exception as e: 
+                self._logger.error(traceback.format_exc())
 
     """
     actually handles task exit/cancellation for the given task
 
-    returns True if the task exited "normally" (without any uncaught exception), False otherwise
-    returns None if we encountered an exception outside of the task
+    the task's wait_task is resolved with True if the task exited "normally" (without any uncaught 
+    exception), False otherwise
     """
-    async def _handle(self, t : asyncio.Task):
-        exited_noexc=None
-        try:
-
-            # retaining original multi-wait invocation in case we need to handle multiple
-            # tasks here again
-            done, _=await asyncio.wait(
-                [ t ], return_when=asyncio.FIRST_COMPLETED
-            )
-            for t in done:
-                tname=t.get_name()
-                try:
-                    if e := t.exception():
-                        self._logger.error(f'task {tname} encountered an exception: ')
-                        self._logger.error(traceback.format_exception(e))
-                        exited_noexc=False
-                        
-                except asyncio.CancelledError:
-                    self._logger.info(f'task {tname} was cancelled')
-
-                try:
-                    self._logger.info(f'task {tname} ended')
-                except KeyError:
-                    self._logger.error('task ended but not present in self.tasks')
-
-                # removal here won't invalidate the list iterator, and we keep tasks_dict
-                # and tasks_list consistent
-                self.tasks_list.remove(tname) 
-                del self.tasks_dict[tname]
-
-                # for now, manually check each VPN lock to see if this task locked it
-                # later, this will be improved when we contain each task in a unified "dynvpn_task"
-                # class that provides access to context. contextvars.Context does not appear to be 
-                # satisfactory for our use case
-                for _, site in self.node.sites.items():
-                    for _, vpn in site.vpn.items():
-                        if vpn.lock is not None and vpn.lock.locked_task == tname:
-                            vpn.lock.unlock(force=True)
-
-
-                exited_noexc=True
-
-            return exited_noexc
-                
-        except Exception as e:
-            self._logger.error(traceback.format_exc())
-            return None
+    def _handle(self, tobj : task_wrapper):
+        t=tobj.task
+        tname=t.get_name()
+        exited_noexc=True
+
+        if t.cancelled():
+            self._logger.info(f'task {tname} was cancelled')
+            self.counters['cancelled'] += 1
+        elif e := t.exception():
+            self._logger.error(f'task {tname} encountered an exception: ')
+            self._logger.error(traceback.format_exception(e))
+            self.counters['failed'] += 1
+            exited_noexc=False
+
+        self.counters['finished'] += 1
+        self._logger.info(f'task {tname} ended')
+
+        # the name may have been reused by a newer task, which stays registered
+        if self.tasks_dict.get(tname) is tobj:
+            del self.tasks_dict[tname]
+
+        if tobj.vpn_tag is not None and (tagged := self._by_vpn.get(tobj.vpn_tag)) is not None:
+            if tagged.get(tname) is tobj:
+                del tagged[tname]
+            if len(tagged) == 0:
+                del self._by_vpn[tobj.vpn_tag]
+
+        # release any VPN locks the task still holds
+        # later, this may be improved when we contain each task in a unified "dynvpn_task"
+        # class that provides access to context. contextvars.Context does not appear to be 
+        # satisfactory for our use case
+        if (n := dynvpn_lock.release_held(t)) > 0:
+            self._logger.debug(f'task {tname} exited holding {n} locks, released')
+
+        if not tobj.wait_task.done():
+            tobj.wait_task.set_result(exited_noexc)
 
 
     """
     wrap `f` in a task and manage it with the task_manager (using _handle, above)
 
-    returns an async awaitable wrapper for f 
-    f's 
+    if `vname` and `kind` are given, the task can also be looked up using find_vpn
+
+    returns an awaitable which resolves once the task has finished and been handled
     """
-    def add(self, f : Coroutine, tname) -> Coroutine:
-        task=asyncio.create_task(f, name=tname)
+    def add(self, f : Coroutine, tname, vname : Optional[str]=None, kind : Optional[task_kind_t]=None) -> Awaitable:
+        if tname in self.tasks_dict:
+            self._logger.warning(f'task_manager.add: task named {tname} already exists')
 
-        wait_task=asyncio.create_task(self._handle(task), name=f'{tname}_wait-task')
-        #self._logger.debug(f'task_manager.add: created task {tname} id={id(task)} waiter task id={id(wait_task)}')
+        task=asyncio.create_task(f, name=tname)
+        wait_task=asyncio.get_running_loop().create_future()
 
         tobj=task_wrapper(
             wait_task=wait_task,
             task=task
         )
         self.tasks_dict[tname]=tobj
-        self.tasks_list.append(tname)
+
+        if vname is not None and kind is not None:
+            tobj.vpn_tag=(vname, kind)
+            self._by_vpn.setdefault(tobj.vpn_tag, dict())[tname]=tobj
+        self.counters['created'] += 1
+
+        task.add_done_callback(lambda _: self._finished.put_nowait(tobj))
 
         return wait_task
 
     def list(self):
-        return self.tasks_list.copy()
+        return list(self.tasks_dict.keys())
 
     def find(self, tname : str):
         try:
             return self.tasks_dict[tname].task
         except KeyError:
-            if tname in self.tasks_list:
-                self._logger.error(f'task_manager.find({tname}): inconsistent state: dict={self.tasks_dict.keys()} list={self.tasks_list}')
             return None
 
+    """
+    return the running tasks which were added with the given vname and kind
+    """
+    def find_vpn(self, vname : str, kind : task_kind_t) -> List[asyncio.Task]:
+        return [ tobj.task for tobj in self._by_vpn.get((vname, kind), {}).values() ]
+
+    def stats(self):
+        return {
+            **self.counters,
+            'running': len(self.tasks_dict),
+            'pending_handle': self._finished.qsize(),
+        }
+
 
     """
     run the same coroutine several times in parallel, with each invocation given a different argument
@@ -0,0 +1,128 @@
+import struct
+
+from typing import Dict
+
+from dynvpn.common import vpn_status_t, vpn_t
+
+"""
+compact binary encoding of the state exchanged between peers (see node._encode_state)
+
+peers negotiate this format using the Content-Type and Accept headers on /peer/*; JSON remains
+the default, so an instance which doesn't know this format keeps working with instances which do
+
+all integers are big-endian. strings are prefixed by their length as u8
+
+    header:
+        magic       2 bytes, b'DV'
+        version     u8
+        flags       u8, bit 0 set for a delta (see node._encode_state)
+        seq         u64
+        epoch       string
+        id          string, ID of the sending site
+        replica_mode    string
+        site count  u16
+    then for each site:
+        site ID     string
+        VPN count   u16
+        then for each VPN:
+            VPN ID      u32, the numeric ID N of the VPN named dynvpnN
+            status      u8, vpn_status_t value
+
+vpn_status_t values are part of the format: new statuses must be added after the existing ones
+"""
+
+content_type='application/x-dynvpn-state'
+
+_magic=b'DV'
+_version=1
+
+_flag_delta=0x1
+
+_header=struct.Struct('>2sBBQ')
+_count=struct.Struct('>H')
+_vpn=struct.Struct('>IB')
+
+
+def _pack_str(s : str) -> bytes:
+    b=s.encode('utf-8')
+    if len(b) > 0xff:
+        raise ValueError(f'wire: string too long: {s}')
+    return bytes([len(b)]) + b
+
+def _unpack_str(data : bytes, offset : int):
+    n=data[offset]
+    end=offset + 1 + n
+    if end > len(data):
+        raise ValueError('wire: truncated string')
+    return (data[offset+1:end].decode('utf-8'), end)
+
+
+"""
+encode a state dict, as built by node._state_dict, with vpn_status_t values
+"""
+def encode_state(state : Dict) -> bytes:
+    flags=_flag_delta if state['delta'] else 0
+
+    parts=[
+        _header.pack(_magic, _version, flags, state['seq']),
+        _pack_str(state['epoch']),
+        _pack_str(state['id']),
+        _pack_str(str(state['replica_mode'])),
+        _count.pack(len(state['state'])),
+    ]
+
+    for site_id, site_state in state['state'].items():
+        parts.append(_pack_str(site_id))
+        parts.append(_count.pack(len(site_state['vpn'])))
+        for vname, status in site_state['vpn'].items():
+            parts.append(_vpn.pack(vpn_t.vpn_id(vname), status.value))
+
+    return b''.join(parts)
+
+
+"""
+decode into the same structure as node._decode_state produces from JSON
+
+raises ValueError if the data is malformed
+"""
+def decode_state(data : bytes) -> Dict:
+    try:
+        (magic, version, flags, seq)=_header.unpack_from(data, 0)
+        if magic != _magic or version != _version:
+            raise ValueError(f'wire: unsupported header: magic={magic} version={version}')
+
+        offset=_header.size
+        (epoch, offset)=_unpack_str(data, offset)
+        (site_id, offset)=_unpack_str(data, offset)
+        (replica_mode, offset)=_unpack_str(data, offset)
+        (nsites,)=_count.unpack_from(data, offset)
+        offset += _count.size
+
+        sites={}
+        for _ in range(nsites):
+            (s_id, offset)=_unpack_str(data, offset)
+            (nvpns,)=_count.unpack_from(data, offset)
+            offset += _count.size
+
+            vpns={}
+            for _ in range(nvpns):
+                (vpn_id, status)=_vpn.unpack_from(data, offset)
+                offset += _vpn.size
+                vpns[vpn_t.vname(vpn_id)]=vpn_status_t(status)
+
+            sites[s_id]={
+                'id': s_id,
+                'vpn': vpns,
+            }
+
+    except (struct.error, IndexError, UnicodeDecodeError) as e:
+        raise ValueError(f'wire: malformed data: {e}')
+
+    return {
+        'id': site_id,
+        'replica_mode': replica_mode,
+        'epoch': epoch,
+        'seq': seq,
+        'delta': bool(flags & _flag_delta),
+        'state': sites,
+    }